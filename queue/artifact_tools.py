@@ -0,0 +1,378 @@
+
+
+import os
+import time
+import zlib
+import errno
+import shutil
+import struct
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# ioctl used to clone (reflink) a file on linux filesystems which
+# support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """create copy of file which shares data blocks with source
+
+    Raises
+        IOError/OSError if filesystem does not support reflinks
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported')
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except (IOError, OSError):
+            os.remove(dst)
+            raise
+
+
+def place_file(src, dst):
+    """place copy of file at dst without copying data when possible
+
+    uses a hardlink, then a reflink, then falls back to a regular copy
+    (e.g. when src and dst are on different filesystems). files placed
+    using links must not be modified
+
+    Returns
+        (str) method used (link, reflink or copy)
+    """
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class ArchiveMember():
+    """file like object used to write a member of a ResultArchive
+
+    data is compressed and written to the archive as it is written to
+    the member. if a loose path is given, data is also written to a
+    regular file at that path (for files which need direct access)
+    """
+    def __init__(self, archive, arcname, loose_path=None, zip64=True):
+        self.archive = archive
+        self.zf = archive.zf
+
+        self.loose_file = None
+        if loose_path is not None:
+            self.loose_file = open(loose_path, 'wb')
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o644 << 16L
+        zinfo.compress_type = archive.compress_type
+        zinfo.flag_bits = 0x00
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.header_offset = self.zf.fp.tell()
+
+        self.zf._writecheck(zinfo)
+        self.zf._didModify = True
+
+        # size of member is not known until it is closed, so header
+        # may need zip64 extra field (header is rewritten on close)
+        self.zip64 = zip64
+        self.zf.fp.write(zinfo.FileHeader(self.zip64))
+
+        self.zinfo = zinfo
+
+        self.cmpr = None
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.cmpr = zlib.compressobj(archive.compress_level,
+                                         zlib.DEFLATED, -15)
+
+        self.closed = False
+
+
+    def write(self, data):
+        if self.loose_file is not None:
+            self.loose_file.write(data)
+
+        self.zinfo.file_size += len(data)
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+
+        if self.cmpr is not None:
+            data = self.cmpr.compress(data)
+
+        self.zinfo.compress_size += len(data)
+        self.zf.fp.write(data)
+
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self.loose_file is not None:
+            self.loose_file.close()
+
+        if self.cmpr is not None:
+            data = self.cmpr.flush()
+            self.zinfo.compress_size += len(data)
+            self.zf.fp.write(data)
+
+        if not self.zip64 and (self.zinfo.file_size > zipfile.ZIP64_LIMIT or
+                               self.zinfo.compress_size > zipfile.ZIP64_LIMIT):
+            raise zipfile.LargeZipFile('member too large for zip without '
+                                       'zip64 ({0})'.format(self.zinfo.filename))
+
+        # rewrite header with crc and sizes
+        position = self.zf.fp.tell()
+        self.zf.fp.seek(self.zinfo.header_offset, 0)
+        self.zf.fp.write(self.zinfo.FileHeader(self.zip64))
+        self.zf.fp.seek(position, 0)
+
+        self.zf.filelist.append(self.zinfo)
+        self.zf.NameToInfo[self.zinfo.filename] = self.zinfo
+
+        self.archive.member = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ResultArchive():
+    """zip archive of request results written as results are generated
+
+    members are streamed into the archive (see open) instead of writing
+    all results to a directory and archiving it afterwards. uses a
+    configurable compression level (zipfile in python 2 always uses
+    the default level)
+
+    static files which are included in every archive (see write_static)
+    are compressed once per process and the compressed data is reused
+    """
+    # path -> (mtime, size, compress level, compress type, crc,
+    #          compressed data) of static files
+    static_members = {}
+
+    def __init__(self, path, compress_level=6):
+        self.path = path
+        self.compress_level = compress_level
+
+        if compress_level == 0:
+            self.compress_type = zipfile.ZIP_STORED
+        else:
+            self.compress_type = zipfile.ZIP_DEFLATED
+
+        self.zf = zipfile.ZipFile(path, 'w', self.compress_type,
+                                  allowZip64=True)
+
+        # member currently being written
+        self.member = None
+
+
+    def open(self, arcname, loose_path=None):
+        """open new member of archive for writing
+
+        only one member can be written at a time
+
+        Args
+            arcname (str): name of member in archive
+            loose_path (str): path of file data is also written to
+        Returns
+            (ArchiveMember) file like object
+        """
+        if self.member is not None:
+            raise Exception('archive member already open ({0})'.format(
+                self.member.zinfo.filename))
+
+        self.member = ArchiveMember(self, arcname, loose_path=loose_path)
+        return self.member
+
+
+    def write_file(self, path, arcname):
+        """add existing file to archive
+        """
+        zip64 = os.path.getsize(path) * 1.05 > zipfile.ZIP64_LIMIT
+
+        if self.member is not None:
+            raise Exception('archive member already open ({0})'.format(
+                self.member.zinfo.filename))
+
+        self.member = ArchiveMember(self, arcname, zip64=zip64)
+
+        with self.member as member, open(path, 'rb') as src:
+            while True:
+                data = src.read(1024 * 64)
+                if not data:
+                    break
+                member.write(data)
+
+
+    def write_static(self, path, arcname):
+        """add static file to archive
+
+        compressed data for file is cached and reused by all archives
+        (until file changes). files which do not compress well (e.g.
+        pdfs, which are already compressed) are stored uncompressed
+        """
+        file_stat = os.stat(path)
+
+        cached = self.static_members.get(path)
+
+        if (cached is None or cached[0] != file_stat.st_mtime
+                or cached[1] != file_stat.st_size
+                or cached[2] != self.compress_level):
+
+            with open(path, 'rb') as src:
+                raw_data = src.read()
+
+            crc = zlib.crc32(raw_data) & 0xffffffff
+
+            compress_type = zipfile.ZIP_STORED
+            data = raw_data
+
+            if self.compress_type == zipfile.ZIP_DEFLATED:
+                cmpr = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+                deflated = cmpr.compress(raw_data) + cmpr.flush()
+                if len(deflated) < len(raw_data) * 0.95:
+                    compress_type = zipfile.ZIP_DEFLATED
+                    data = deflated
+
+            cached = (file_stat.st_mtime, file_stat.st_size,
+                      self.compress_level, compress_type, crc, data)
+            self.static_members[path] = cached
+
+        mtime, size, level, compress_type, crc, data = cached
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(mtime)[:6])
+        zinfo.external_attr = 0o644 << 16L
+        zinfo.compress_type = compress_type
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zinfo.CRC = crc
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.zf.fp.tell()
+
+        self.zf._writecheck(zinfo)
+        self.zf._didModify = True
+
+        self.zf.fp.write(zinfo.FileHeader())
+        self.zf.fp.write(data)
+
+        self.zf.filelist.append(zinfo)
+        self.zf.NameToInfo[zinfo.filename] = zinfo
+
+
+    def copy_member(self, src_path, src_arcname, arcname):
+        """add member of another zip archive to archive
+
+        compressed data of member is copied as is, along with its crc and
+        sizes, so it is not read and compressed again (e.g. to reuse the
+        merged results of a request with the same fingerprint)
+
+        Args
+            src_path (str): path of zip archive member is copied from
+            src_arcname (str): name of member in source archive
+            arcname (str): name of member in archive
+
+        Raises
+            KeyError if source archive does not have member,
+            zipfile.BadZipfile if member can not be copied
+        """
+        if self.member is not None:
+            raise Exception('archive member already open ({0})'.format(
+                self.member.zinfo.filename))
+
+        with open(src_path, 'rb') as src:
+
+            src_zf = zipfile.ZipFile(src)
+            src_info = src_zf.getinfo(src_arcname)
+            src_zf.close()
+
+            if (src_info.flag_bits & 0x1 or src_info.compress_type not in
+                    [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]):
+                raise zipfile.BadZipfile('unsupported member ({0})'.format(
+                    src_arcname))
+
+            # compressed data follows local header of member
+            src.seek(src_info.header_offset, 0)
+            fheader = src.read(zipfile.sizeFileHeader)
+            if len(fheader) != zipfile.sizeFileHeader:
+                raise zipfile.BadZipfile('truncated member header')
+
+            fheader = struct.unpack(zipfile.structFileHeader, fheader)
+            if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+                raise zipfile.BadZipfile('bad member header')
+
+            src.seek(fheader[zipfile._FH_FILENAME_LENGTH] +
+                     fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+            zinfo = zipfile.ZipInfo(arcname, src_info.date_time)
+            zinfo.external_attr = 0o644 << 16L
+            zinfo.compress_type = src_info.compress_type
+            zinfo.file_size = src_info.file_size
+            zinfo.compress_size = src_info.compress_size
+            zinfo.CRC = src_info.CRC
+            zinfo.flag_bits = 0x00
+            zinfo.header_offset = self.zf.fp.tell()
+
+            self.zf._writecheck(zinfo)
+            self.zf._didModify = True
+
+            try:
+                self.zf.fp.write(zinfo.FileHeader())
+
+                remaining = zinfo.compress_size
+                while remaining > 0:
+                    data = src.read(min(remaining, 1024 * 64))
+                    if not data:
+                        raise zipfile.BadZipfile('truncated member data')
+                    self.zf.fp.write(data)
+                    remaining -= len(data)
+
+            except:
+                # remove partially copied member
+                self.zf.fp.seek(zinfo.header_offset, 0)
+                self.zf.fp.truncate()
+                raise
+
+        self.zf.filelist.append(zinfo)
+        self.zf.NameToInfo[zinfo.filename] = zinfo
+
+
+    def write_dir(self, arcname):
+        """add directory entry to archive
+        """
+        if not arcname.endswith('/'):
+            arcname += '/'
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = (0o40755 << 16L) | 0x10
+        zinfo.compress_type = zipfile.ZIP_STORED
+
+        self.zf.writestr(zinfo, '')
+
+
+    def close(self):
+        if self.member is not None:
+            self.member.close()
+
+        self.zf.close()
@@ -0,0 +1,199 @@
+
+
+import os
+import json
+import shutil
+import tempfile
+
+import pandas as pd
+
+from extract_reader import read_extract_chunks, DEFAULT_CHUNK_SIZE
+
+
+class BaseTableCache():
+    """cache of boundary attribute columns used in merged extracts
+
+    every extract for a boundary has the same non extract columns
+    (asdf_id and boundary attributes), so they are parsed once per
+    boundary and extract version and stored as pandas pickles. merges
+    start from the cached table and only add extract columns to it
+
+    tables are read from the extract csv and stored in parts of rows (a
+    pickle per part), so they are never loaded whole. parts are read one
+    at a time and cut into chunks of the size used by the merge
+
+    a cached table is only used if it has the same columns as the
+    extract being merged
+    """
+    # increment if format of cached tables changes
+    format_version = 1
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def table_path(self, key):
+        """get path of cached table directory
+
+        Args
+            key (tuple): (boundary name, extract version)
+        """
+        boundary, version = key
+        return os.path.join(self.path, '{0}.{1}.parts'.format(boundary, version))
+
+
+    def part_paths(self, key, fields):
+        """get paths of parts of cached table
+
+        Args
+            key (tuple): (boundary name, extract version)
+            fields (list): non extract columns of extract being merged
+        Returns
+            (list) paths of parts, None if there is no valid table
+        """
+        table_path = self.table_path(key)
+
+        try:
+            with open(os.path.join(table_path, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (meta.get('format_version') != self.format_version
+                or meta.get('columns') != list(fields)):
+            return None
+
+        part_paths = [os.path.join(table_path, part) for part in meta['parts']]
+
+        if not all(os.path.isfile(part_path) for part_path in part_paths):
+            return None
+
+        return part_paths
+
+
+    def load(self, key, fields, chunk_size=None):
+        """load cached table
+
+        Args
+            key (tuple): (boundary name, extract version)
+            fields (list): non extract columns of extract being merged
+            chunk_size (int): number of rows per chunk. whole table is
+                              returned as a single chunk if None
+        Returns
+            iterator of dataframes, None if there is no valid table
+        """
+        part_paths = self.part_paths(key, fields)
+
+        if part_paths is None:
+            return None
+
+        parts = (pd.read_pickle(part_path) for part_path in part_paths)
+
+        return iter_rechunked(parts, chunk_size)
+
+
+    def create(self, key, extract_path, fields, chunk_size=None):
+        """cache table from non extract columns of extract csv
+
+        csv is read in chunks and each chunk is saved as a part, so memory
+        use is bounded by the chunk size. table is written to a temporary
+        directory and moved into place. errors writing the table are
+        ignored since the cache is optional
+
+        a valid table is never replaced, since other processes may be
+        reading its parts (e.g. when several builds miss the same table).
+        only a table which is missing or does not match the columns is
+        replaced
+
+        Args
+            key (tuple): (boundary name, extract version)
+            extract_path (str): path of extract csv
+            fields (list): non extract columns of extract
+            chunk_size (int): rows read from csv at a time
+        Returns
+            (bool) whether table was cached
+        """
+        if chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+
+        if self.part_paths(key, fields) is not None:
+            return True
+
+        table_path = self.table_path(key)
+
+        tmp_path = None
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            tmp_path = tempfile.mkdtemp(prefix='.tmp_parts_', dir=self.path)
+
+            meta = {
+                'format_version': self.format_version,
+                'columns': list(fields),
+                'parts': []
+            }
+
+            for ix, chunk in enumerate(read_extract_chunks(
+                    extract_path, usecols=fields, chunk_size=chunk_size)):
+
+                part = '{0}.pkl'.format(ix)
+                # read_csv keeps order of file, not of usecols
+                chunk[fields].to_pickle(os.path.join(tmp_path, part))
+                meta['parts'].append(part)
+
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+                json.dump(meta, meta_file)
+
+            if self.part_paths(key, fields) is not None:
+                # table was created by another process while reading
+                return True
+
+            if os.path.isdir(table_path):
+                shutil.rmtree(table_path, ignore_errors=True)
+
+            os.rename(tmp_path, table_path)
+            tmp_path = None
+
+        except (IOError, OSError):
+            return False
+
+        finally:
+            if tmp_path is not None:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return True
+
+
+def iter_rechunked(parts, chunk_size=None):
+    """iterate over rows of dataframes in chunks of rows
+
+    only the current part (and rows left over from the previous part) is
+    kept in memory
+
+    Args
+        parts (iterator): dataframes with the same columns
+        chunk_size (int): number of rows per chunk. all rows are returned
+                          as a single chunk if None
+    """
+    if chunk_size is None:
+        parts = list(parts)
+        if len(parts) > 0:
+            yield pd.concat(parts)
+        return
+
+    buffered = None
+
+    for part in parts:
+
+        if buffered is not None and len(buffered) > 0:
+            buffered = pd.concat([buffered, part])
+        else:
+            buffered = part
+
+        while len(buffered) >= chunk_size:
+            yield buffered.iloc[:chunk_size]
+            buffered = buffered.iloc[chunk_size:]
+
+    if buffered is not None and len(buffered) > 0:
+        yield buffered
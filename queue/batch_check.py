@@ -0,0 +1,158 @@
+
+
+from collections import OrderedDict
+
+from pymongo import UpdateOne, UpdateMany
+
+
+class ItemBatch():
+    """check status of and queue many extract/msr items at once
+
+    items (ExtractItem or MSRItem) are looked up using a single query per
+    queue collection, and missing items are added to each queue collection
+    using a single bulk write, instead of one or more queries per item
+
+    if a StatusCache is given, items already checked or queued in the
+    current processing pass are not looked up or queued again
+    """
+    def __init__(self, status_cache=None):
+        # fields returned when looking up items (in addition to key fields)
+        self.status_fields = ['status']
+
+        self.status_cache = status_cache
+
+
+    def find_status(self, items):
+        """lookup status of items in their queue collections
+
+        Args
+            items (list): extract or msr items
+        Returns
+            (dict) item key -> status for all items which exist in db
+        """
+        # group items by collection, then by all key fields except the
+        # last so that each group only needs a single $in
+        groups = OrderedDict()
+        for item in items:
+            name = item.collection.full_name
+            if name not in groups:
+                groups[name] = (item.collection, item.key_fields, OrderedDict())
+
+            key_values = groups[name][2].setdefault(item.key[:-1], [])
+            if item.key[-1] not in key_values:
+                key_values.append(item.key[-1])
+
+
+        status = {}
+
+        for collection, key_fields, key_groups in groups.values():
+
+            search_list = []
+            for prefix, key_values in key_groups.iteritems():
+                search = dict(zip(key_fields[:-1], prefix))
+                search[key_fields[-1]] = {'$in': key_values}
+                search_list.append(search)
+
+            if len(search_list) == 1:
+                search = search_list[0]
+            else:
+                search = {'$or': search_list}
+
+            projection = dict((f, 1) for f in key_fields + tuple(self.status_fields))
+            projection['_id'] = 0
+
+            for result in collection.find(search, projection):
+                key = tuple(result.get(f) for f in key_fields)
+                # keep first match for key (same as find_one)
+                if key not in status:
+                    status[key] = result['status']
+
+        return status
+
+
+    def resolve(self, items):
+        """get status of items
+
+        Args
+            items (list): extract or msr items
+        Returns
+            (list) tuple of (exists, completed) for each item, in same order
+            as items (same as item.exists())
+        """
+        if len(items) == 0:
+            return []
+
+        results = [None] * len(items)
+
+        if self.status_cache is not None:
+            self.status_cache.load(items)
+            results = [self.status_cache.get(item) for item in items]
+
+        unchecked = [ix for ix, result in enumerate(results)
+                     if result is None]
+
+        if len(unchecked) == 0:
+            return results
+
+        status = self.find_status([items[ix] for ix in unchecked])
+
+        for ix in unchecked:
+            item = items[ix]
+            results[ix] = item.evaluate(item.key in status,
+                                        status.get(item.key))
+
+        if self.status_cache is not None:
+            self.status_cache.set_many([items[ix] for ix in unchecked],
+                                       [results[ix] for ix in unchecked])
+
+        return results
+
+
+    def enqueue(self, queue_items, request_id=None, done_items=None):
+        """add items to queue collections
+
+        if a request id is given, it is added to the det_requests field of
+        each queued item (requests waiting on item) and removed from the
+        det_requests field of each done item
+
+        Args
+            queue_items (list): (item, update) tuples, where update is the
+                                (collection, query, update) tuple from
+                                queue_update of the extract or msr item
+            request_id (str): id of request waiting on queued items
+            done_items (list): extract or msr items request no longer
+                               waits on
+        """
+        ops = OrderedDict()
+
+        def add_op(collection, op):
+            name = collection.full_name
+            if name not in ops:
+                ops[name] = (collection, [])
+            ops[name][1].append(op)
+
+        for item, (collection, query, update) in queue_items:
+
+            if self.status_cache is not None:
+                if self.status_cache.is_queued(item):
+                    # already queued in this pass, only register request
+                    if request_id is not None:
+                        add_op(collection, UpdateOne(
+                            query, {'$addToSet': {'det_requests': request_id}}))
+                    continue
+                self.status_cache.set_queued(item)
+
+            if request_id is not None:
+                update = dict(update)
+                update['$addToSet'] = {'det_requests': request_id}
+
+            add_op(collection, UpdateOne(query, update, upsert=True))
+
+        if request_id is not None and done_items is not None:
+            for item in done_items:
+                query = dict(zip(item.key_fields, item.key))
+                add_op(item.collection, UpdateMany(
+                    query, {'$pull': {'det_requests': request_id}}))
+
+        for collection, collection_ops in ops.values():
+            collection.bulk_write(collection_ops, ordered=False)
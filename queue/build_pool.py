@@ -0,0 +1,332 @@
+
+
+import time
+import threading
+import traceback
+import multiprocessing
+
+from doc_assets import shared_assets
+
+
+def run_build_worker(make_queue, branch, conn):
+    """build outputs for requests received through conn (in build worker
+    process) until None is received
+
+    the queue tool box (and its config and mongo client) is created for
+    the first build and reused by every later build, so caches kept in
+    the process (documentation metadata, fragments and assets) stay warm
+    between builds. sends tuple (request id, error message or None)
+    through conn when each build finishes
+    """
+    build_queue = None
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+
+        if job is None:
+            break
+
+        request, merge_list, doc_path = job
+        request_id = str(request['_id'])
+
+        error = None
+
+        try:
+            # pick up changes to documentation templates
+            shared_assets.refresh()
+
+            if build_queue is None:
+                # clients can not be shared with forked processes, so each
+                # worker uses its own queue tool box and mongo client
+                build_queue = make_queue()
+
+            build_queue.build_output(request, merge_list, branch, doc_path)
+        except Exception as e:
+            traceback.print_exc()
+            error = repr(e)
+
+        conn.send((request_id, error))
+
+    conn.close()
+
+
+class BuildWorker():
+    """long lived process which builds outputs of requests one at a time
+
+    Args
+        make_queue (function): returns QueueToolBox for worker process
+        branch (str): branch name
+    """
+    def __init__(self, make_queue, branch):
+        self.conn, child_conn = multiprocessing.Pipe()
+
+        # not daemonic, so builds can use a process pool to parse extracts
+        self.process = multiprocessing.Process(
+            target=run_build_worker, args=(make_queue, branch, child_conn))
+        self.process.start()
+
+        # only the worker uses its end of the pipe
+        child_conn.close()
+
+        # id of request being built, None if worker is idle
+        self.request_id = None
+
+
+    def submit(self, request_id, request, merge_list, doc_path=None):
+        """start build of output for request
+        """
+        self.conn.send((request, merge_list, doc_path))
+        self.request_id = request_id
+
+
+    def finished(self):
+        """get result of build if it finished
+
+        Returns
+            tuple (request id, error message or None), None if worker is
+            idle or still building
+        """
+        if self.request_id is None:
+            return None
+
+        if not self.conn.poll() and self.process.is_alive():
+            return None
+
+        request_id = self.request_id
+        self.request_id = None
+
+        try:
+            result_id, error = self.conn.recv()
+        except (EOFError, IOError):
+            # worker exited without sending a result (e.g. killed when
+            # out of memory)
+            self.process.join()
+            error = "build process exited unexpectedly (exit code {0})".format(
+                self.process.exitcode)
+
+        return request_id, error
+
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+
+    def stop(self):
+        """stop worker after its current build
+        """
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            # worker already exited
+            pass
+
+        self.process.join()
+        self.conn.close()
+
+
+class BuildPool():
+    """bounded pool of processes which build output for requests
+
+    builds run in the background so the caller can keep checking
+    requests while outputs are built. up to processes build workers are
+    started (when there are builds for them) and kept for the life of the
+    pool, each building one request at a time, so caches kept in their
+    processes are reused by later builds. builds wait for an idle worker
+    when all workers are busy
+
+    leases of requests being built (or waiting to be built) are renewed
+    in a background thread, which also watches build workers. a worker
+    which dies (e.g. killed when out of memory) is replaced, and on_done
+    is called with an error for the request it was building
+
+    Args
+        processes (int): max number of build processes
+        make_queue (function): returns QueueToolBox for a build process
+        branch (str): branch name
+        renew (function): renew(request_id) renews lease of request,
+                          returns False if request is no longer claimed
+        on_done (function): on_done(request_id, email, error) is called
+                            when build finishes (error is None if build
+                            succeeded)
+        renew_interval (int): seconds between lease renewals
+        max_pending (int): max requests building or waiting for a slot,
+                           submit blocks until a build finishes when
+                           reached (defaults to twice the processes)
+    """
+    def __init__(self, processes, make_queue, branch, renew, on_done,
+                 renew_interval=60*15, max_pending=None):
+
+        self.processes = processes
+        self.make_queue = make_queue
+        self.branch = branch
+        self.renew = renew
+        self.on_done = on_done
+        self.renew_interval = renew_interval
+
+        if max_pending is None:
+            max_pending = processes * 2
+        self.max_pending = max_pending
+
+        # request id -> email for requests building or waiting
+        self.pending = {}
+
+        # (request id, request, merge list, doc path) of builds waiting for
+        # a worker
+        self.waiting = []
+
+        # BuildWorker instances
+        self.workers = []
+
+        self.lock = threading.Condition()
+
+        self.closed = False
+
+        self.monitor_thread = threading.Thread(target=self.__monitor_loop)
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+
+
+    def submit(self, request, merge_list, email, doc_path=None):
+        """start build of output for request
+
+        Args
+            request (dict): request object
+            merge_list (list): extracts to merge, see check_request
+            email (str): email of user who submitted request
+            doc_path (str): documentation already generated for request
+                            (see QueueToolBox.build_ready_docs)
+        """
+        request_id = str(request['_id'])
+
+        with self.lock:
+            while len(self.pending) >= self.max_pending:
+                self.lock.wait(1)
+
+            self.pending[request_id] = email
+            self.waiting.append((request_id, request, merge_list, doc_path))
+            self.__start_waiting()
+
+
+    def __start_waiting(self):
+        """hand waiting builds to idle workers, starting workers while
+        there are fewer than processes (lock must be held)
+        """
+        while self.waiting:
+            idle = [w for w in self.workers if w.request_id is None]
+
+            if len(idle) > 0:
+                worker = idle[0]
+            elif len(self.workers) < self.processes:
+                worker = BuildWorker(self.make_queue, self.branch)
+                self.workers.append(worker)
+            else:
+                break
+
+            request_id, request, merge_list, doc_path = self.waiting.pop(0)
+            worker.submit(request_id, request, merge_list, doc_path)
+
+
+    def __finished_builds(self):
+        """get finished builds and remove workers which have exited (lock
+        must be held)
+
+        Returns
+            list of (request id, error message or None)
+        """
+        finished = []
+
+        for worker in list(self.workers):
+
+            result = worker.finished()
+            if result is not None:
+                finished.append(result)
+
+            if worker.request_id is None and not worker.is_alive():
+                # replaced when there is a build for it
+                worker.stop()
+                self.workers.remove(worker)
+
+        return finished
+
+
+    def __build_done(self, request_id, error):
+        """handle finished build (runs in monitor thread)
+        """
+        with self.lock:
+            email = self.pending.get(request_id)
+
+        try:
+            self.on_done(request_id, email, error)
+        except Exception as e:
+            print "error finishing request (id: {0})".format(request_id)
+            traceback.print_exc()
+
+        with self.lock:
+            self.pending.pop(request_id, None)
+            self.__start_waiting()
+            self.lock.notify_all()
+
+
+    def __renew_pending(self):
+        """renew leases of pending requests
+        """
+        with self.lock:
+            request_ids = list(self.pending.keys())
+
+        for request_id in request_ids:
+            try:
+                if not self.renew(request_id):
+                    print "Lost claim on request during build. Id: {0}".format(request_id)
+            except Exception as e:
+                print "error renewing lease (id: {0})".format(request_id)
+                traceback.print_exc()
+
+
+    def __monitor_loop(self):
+        """handle finished builds and renew leases of pending requests
+        until pool is closed
+        """
+        last_renew = time.time()
+
+        while True:
+            with self.lock:
+                if not self.closed:
+                    self.lock.wait(1)
+                if self.closed and len(self.pending) == 0:
+                    return
+                finished = self.__finished_builds()
+
+            for request_id, error in finished:
+                self.__build_done(request_id, error)
+
+            if time.time() - last_renew > self.renew_interval:
+                last_renew = time.time()
+                self.__renew_pending()
+
+
+    def wait(self):
+        """wait for all submitted builds to finish
+        """
+        with self.lock:
+            while len(self.pending) > 0:
+                self.lock.wait(1)
+
+
+    def close(self):
+        """wait for builds to finish, then stop monitor thread and build
+        workers
+        """
+        self.wait()
+
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+        self.monitor_thread.join()
+
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
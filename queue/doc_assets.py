@@ -0,0 +1,152 @@
+
+
+import os
+import threading
+
+from reportlab.platypus import Image, TableStyle
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib import colors
+from reportlab.lib.units import inch
+from reportlab.lib.enums import TA_JUSTIFY, TA_CENTER
+
+
+class AssetRegistry():
+    """templates, styles and images used by documentation and status
+    updates
+
+    assets are loaded the first time they are used and then shared by
+    everything in the process (DocBuilder instances, QueueToolBox), so
+    template files and the logo are not read again for every request.
+    call refresh (once per processing pass) to pick up changes to files
+
+    Args
+        template_dir (str): path to templates directory
+    """
+    def __init__(self, template_dir):
+        self.template_dir = template_dir
+
+        self.lock = threading.Lock()
+
+        # template name -> tuple of lines
+        self.templates = {}
+
+        # path -> mtime of files assets were loaded from
+        self.mtimes = {}
+
+        self.__styles = None
+        self.__table_style = None
+        self.__logo = None
+
+
+    def reload(self):
+        """clear loaded assets so they are loaded again when used
+        """
+        with self.lock:
+            self.templates = {}
+            self.mtimes = {}
+            self.__logo = None
+
+
+    def refresh(self):
+        """reload assets if any of the files they were loaded from changed
+
+        Returns
+            (bool) whether assets were reloaded
+        """
+        with self.lock:
+            mtimes = self.mtimes.items()
+
+        for path, mtime in mtimes:
+            try:
+                changed = os.path.getmtime(path) != mtime
+            except OSError:
+                changed = True
+
+            if changed:
+                print "documentation assets changed, reloading"
+                self.reload()
+                return True
+
+        return False
+
+
+    def template_lines(self, name):
+        """get lines of text template
+
+        Args
+            name (str): name of template (file in templates dir without
+                        .txt extension)
+        Returns
+            (tuple) lines of template
+        """
+        lines = self.templates.get(name)
+
+        if lines is None:
+            path = os.path.join(self.template_dir, '{0}.txt'.format(name))
+            mtime = os.path.getmtime(path)
+            with open(path) as template:
+                lines = tuple(template)
+
+            with self.lock:
+                self.templates[name] = lines
+                self.mtimes[path] = mtime
+
+        return lines
+
+
+    def column_info_html(self):
+        """get column info template as html (used for request info)
+        """
+        return ''.join(self.template_lines('column_info')).replace('\n', '<br/>')
+
+
+    @property
+    def styles(self):
+        """paragraph style sheet (sample style sheet with Justify and
+        Center styles)
+        """
+        if self.__styles is None:
+            styles = getSampleStyleSheet()
+            styles.add(ParagraphStyle(name='Justify', alignment=TA_JUSTIFY))
+            styles.add(ParagraphStyle(name='Center', alignment=TA_CENTER))
+            self.__styles = styles
+
+        return self.__styles
+
+
+    @property
+    def table_style(self):
+        """grid style used by all documentation tables
+        """
+        if self.__table_style is None:
+            self.__table_style = TableStyle([
+                ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
+                ('BOX', (0,0), (-1,-1), 0.25, colors.black)
+            ])
+
+        return self.__table_style
+
+
+    @property
+    def logo(self):
+        """aiddata logo flowable
+
+        the same flowable is used by every document, so the image is
+        only read and decoded once
+        """
+        if self.__logo is None:
+            path = os.path.join(self.template_dir, 'logo.png')
+            mtime = os.path.getmtime(path)
+            logo = Image(path, 2.188*inch, 0.5*inch)
+            logo.hAlign = 'LEFT'
+
+            with self.lock:
+                self.__logo = logo
+                self.mtimes[path] = mtime
+
+        return self.__logo
+
+
+# registry shared by everything in process
+shared_assets = AssetRegistry(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
@@ -0,0 +1,115 @@
+
+
+import time
+import traceback
+import multiprocessing
+
+from documentation_tool import DocBuilder, STATIC_SECTIONS
+from meta_cache import shared_meta_cache, request_meta_names
+
+
+# mongo client and download server used by doc worker process
+worker_client = None
+worker_server = None
+
+
+def init_doc_worker(make_client, download_server):
+    """create mongo client for doc worker process
+
+    each worker uses its own client, since clients can not be shared
+    with forked processes
+    """
+    global worker_client, worker_server
+    worker_client = make_client()
+    worker_server = download_server
+
+
+def run_doc(args):
+    """build documentation for request in doc worker process
+
+    Returns
+        tuple (request id, output path, seconds, error message or None)
+    """
+    request, output = args
+
+    request_id = str(request['_id'])
+
+    t0 = time.time()
+
+    try:
+        doc = DocBuilder(worker_client, request, output, worker_server)
+        doc.build_doc()
+    except Exception as e:
+        traceback.print_exc()
+        return request_id, output, time.time() - t0, repr(e)
+
+    return request_id, output, time.time() - t0, None
+
+
+def build_docs(jobs, make_client, download_server, processes=None):
+    """build documentation for a batch of requests
+
+    metadata for every dataset in the batch is loaded with a single query
+    and the static doc sections are rendered before worker processes are
+    started, so workers inherit them instead of each loading them
+
+    Args
+        jobs (list): (request object, output path) tuples
+        make_client (function): returns mongo client
+        download_server (str): download server used in doc links
+        processes (int): number of worker processes (defaults to number
+                         of cpus). documents are built in this process
+                         if 1
+    Returns
+        (list) (request id, output path, seconds, error message or None)
+               tuples, in the same order as jobs
+    """
+    global worker_client, worker_server
+
+    if len(jobs) == 0:
+        return []
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+
+    t0 = time.time()
+
+    client = make_client()
+
+    names = set()
+    for request, output in jobs:
+        names.update(request_meta_names(request))
+
+    shared_meta_cache.prefetch(client.asdf.data, names)
+
+    doc = DocBuilder(client, jobs[0][0], None, download_server)
+    if doc.splice_static:
+        for templates in STATIC_SECTIONS:
+            doc.get_static_section(templates)
+
+    if processes == 1:
+        worker_client = client
+        worker_server = download_server
+        results = [run_doc(job) for job in jobs]
+
+    else:
+        pool = multiprocessing.Pool(processes,
+                                    initializer=init_doc_worker,
+                                    initargs=(make_client, download_server))
+        try:
+            results = pool.map(run_doc, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    for request_id, output, seconds, error in results:
+        if error is None:
+            print "doc built ({0:.2f}s): {1}".format(seconds, request_id)
+        else:
+            print "doc failed ({0:.2f}s): {1} {2}".format(seconds, request_id, error)
+
+    print "built {0} docs using {1} processes ({2:.2f}s)".format(
+        len(jobs), processes, time.time() - t0)
+
+    return results
@@ -2,38 +2,137 @@
 
 import os
 import time
+import threading
 import pymongo
+from io import BytesIO
+from collections import OrderedDict
 
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table, LongTable
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib.units import inch
-from reportlab.lib.enums import TA_JUSTIFY, TA_CENTER
+
+from meta_cache import shared_meta_cache, request_meta_names
+from doc_assets import shared_assets
+
+# PyPDF2 is optional, used to splice pre-rendered static pages into
+# documents (documents are fully rendered without it)
+try:
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+except ImportError:
+    PdfFileReader = None
+    PdfFileWriter = None
 
 
 # =============================================================================
 
-styles = getSampleStyleSheet()
+# templates of sections which are the same for every request and start on
+# a new page. they are rendered once and reused by all documents
+STATIC_SECTIONS = [
+    ['field_names', 'notes', 'aid_data'],
+    ['additional']
+]
+
+# (template names and lines) -> rendered pdf of static section
+static_fragments = {}
+static_fragments_lock = threading.Lock()
+
+# (dataset name, item type, date updated) -> meta table rows, least
+# recently used entries are removed when there are more than
+# META_FRAGMENTS_MAX entries
+META_FRAGMENTS_MAX = 500
+meta_fragments = OrderedDict()
+meta_fragments_lock = threading.Lock()
+
+# width available to tables (letter page with default SimpleDocTemplate
+# margins and frame padding)
+TABLE_WIDTH = letter[0] - 2*inch - 12
+
+# max temporal values (or ranges) in a single row of overview tables,
+# long selections are split over multiple rows so the table can split
+# across pages
+TEMPORAL_ROW_SIZE = 40
+
+
+def label_table(data):
+    """create table of (label, value) rows
+
+    column widths are computed from the labels instead of having reportlab
+    size columns using the contents of every cell, and the table can be
+    split across pages (between rows)
+    """
+    label_width = 0
+    for row in data:
+        if isinstance(row[0], basestring):
+            width = stringWidth(row[0], 'Helvetica', 10)
+        else:
+            width = row[0].minWidth()
+        label_width = max(label_width, width)
+
+    # cell padding
+    label_width += 12
+
+    t = LongTable(data, colWidths=[label_width, TABLE_WIDTH - label_width])
+    t.setStyle(shared_assets.table_style)
+    return t
+
+
+def compact_temporal(values):
+    """compact temporal values by combining consecutive values into ranges
+
+    values are sorted newest first, e.g. ['2016', '1990', '1989', '1988']
+    becomes ['2016', '1988-1990'] (using an en dash). values which are not
+    all integers are returned unchanged
+
+    Returns
+        (list) temporal values and ranges
+    """
+    try:
+        temporal_int = sorted(set(int(s) for s in values), reverse=True)
+    except ValueError:
+        return list(values)
+
+    ranges = []
+    for i in temporal_int:
+        if len(ranges) > 0 and ranges[-1][0] == i + 1:
+            ranges[-1][0] = i
+        else:
+            ranges.append([i, i])
+
+    return [str(start) if start == end
+            else '{0}\xe2\x80\x93{1}'.format(start, end)
+            for start, end in ranges]
+
 
 def pg(text, pg_type):
     """return paragraph of specified type for given text
     """
     if pg_type == 1:
-        return Paragraph(text, styles['Normal'])
+        return Paragraph(text, shared_assets.styles['Normal'])
     elif pg_type == 2:
-        return Paragraph(text, styles['BodyText'])
+        return Paragraph(text, shared_assets.styles['BodyText'])
     else:
         raise Exception("invalid paragraph type")
 
 
 class DocBuilder():
 
-    def __init__(self, client, request, output, download_server):
+    def __init__(self, client, request, output, download_server,
+                 meta_cache=None, assets=None):
 
         self.client = client
         self.c_asdf = self.client.asdf.data
 
+        # dataset metadata cache, shared by all instances unless given
+        if meta_cache is None:
+            meta_cache = shared_meta_cache
+        self.meta_cache = meta_cache
+
+        # templates, styles and logo, shared by all instances unless given
+        if assets is None:
+            assets = shared_assets
+        self.assets = assets
+
         self.request_id = str(request['_id'])
         self.request = request
         self.output = output
@@ -46,9 +145,10 @@ class DocBuilder():
         # container for the 'Flowable' objects
         self.Story = []
 
-        self.styles = getSampleStyleSheet()
-        self.styles.add(ParagraphStyle(name='Justify', alignment=TA_JUSTIFY))
-        self.styles.add(ParagraphStyle(name='Center', alignment=TA_CENTER))
+        # splice cached static sections into document when possible
+        self.splice_static = PdfFileReader is not None
+
+        self.styles = self.assets.styles
 
 
 
@@ -71,6 +171,17 @@ class DocBuilder():
 
         # try:
 
+        # load metadata for all datasets in request with one query
+        self.meta_cache.prefetch(self.c_asdf, request_meta_names(self.request))
+
+        if self.splice_static:
+            try:
+                self.build_spliced_doc()
+                return True
+            except Exception as e:
+                print "Splicing static doc sections failed, building full doc ({0})".format(e)
+                self.Story = []
+
         self.doc = SimpleDocTemplate(self.output, pagesize=letter)
 
         # build doc call all functions
@@ -99,14 +210,101 @@ class DocBuilder():
         #     return False
 
 
+    def build_spliced_doc(self):
+        """build doc from request specific pages and cached static sections
+
+        produces the same pages as a full build, but the static sections
+        (see STATIC_SECTIONS) are only rendered once per process (and
+        again if their templates change)
+        """
+        self.Story = []
+        self.add_header()
+        self.Story.append(Spacer(1, 0.5*inch))
+        self.add_info()
+        self.Story.append(Spacer(1, 0.3*inch))
+        self.add_timeline()
+        self.Story.append(Spacer(1, 0.3*inch))
+        self.add_template('general')
+        intro_pdf = self.render_story(self.Story)
+
+        self.Story = []
+        self.add_overview()
+        self.Story.append(PageBreak())
+        self.add_meta()
+        request_pdf = self.render_story(self.Story)
+
+        parts = [
+            intro_pdf,
+            self.get_static_section(STATIC_SECTIONS[0]),
+            request_pdf,
+            self.get_static_section(STATIC_SECTIONS[1])
+        ]
+
+        writer = PdfFileWriter()
+        for part in parts:
+            reader = PdfFileReader(BytesIO(part))
+            for page_num in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page_num))
+
+        with open(self.output, 'wb') as output_file:
+            writer.write(output_file)
+
+
+    def render_story(self, story):
+        """render flowables to pdf
+
+        Returns
+            (str) pdf data
+        """
+        buf = BytesIO()
+        SimpleDocTemplate(buf, pagesize=letter).build(story)
+        return buf.getvalue()
+
+
+    def get_static_section(self, templates):
+        """get rendered pdf of static section
+
+        section is rendered the first time it is needed, and again if
+        any of its templates change (see AssetRegistry.reload)
+
+        Args
+            templates (list): names of templates in section, each template
+                              starts on a new page
+        Returns
+            (str) pdf data
+        """
+        key = tuple((i, self.assets.template_lines(i)) for i in templates)
+
+        with static_fragments_lock:
+            fragment = static_fragments.get(key)
+
+        if fragment is None:
+            self.Story = []
+            for ix, name in enumerate(templates):
+                if ix > 0:
+                    self.Story.append(PageBreak())
+                self.add_template(name)
+
+            fragment = self.render_story(self.Story)
+
+            with static_fragments_lock:
+                static_fragments[key] = fragment
+
+        return fragment
+
+
+    def add_template(self, name):
+        """add paragraph for each line of template
+        """
+        for line in self.assets.template_lines(name):
+            p = Paragraph(line, self.styles['BodyText'])
+            self.Story.append(p)
+
+
     # documentation header
     def add_header(self):
         # aiddata logo
-        logo = self.dir_base + '/templates/logo.png'
-
-        im = Image(logo, 2.188*inch, 0.5*inch)
-        im.hAlign = 'LEFT'
-        self.Story.append(im)
+        self.Story.append(self.assets.logo)
 
         self.Story.append(Spacer(1, 0.25*inch))
 
@@ -133,10 +331,7 @@ class DocBuilder():
         data = [[i[0], pg(i[1], 1)] for i in data]
         t = Table(data)
 
-        t.setStyle(TableStyle([
-            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-            ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-        ]))
+        t.setStyle(self.assets.table_style)
 
         self.Story.append(t)
 
@@ -159,10 +354,7 @@ class DocBuilder():
         data = [[i[0], pg(i[1], 1)] for i in data]
         t = Table(data)
 
-        t.setStyle(TableStyle([
-            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-            ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-        ]))
+        t.setStyle(self.assets.table_style)
 
         self.Story.append(t)
 
@@ -171,31 +363,16 @@ class DocBuilder():
     # intro paragraphs
     def add_general(self):
 
-        with open(self.dir_base + '/templates/general.txt') as general:
-            for line in general:
-                p = Paragraph(line, self.styles['BodyText'])
-                self.Story.append(p)
-
+        self.add_template('general')
         self.Story.append(PageBreak())
 
-        with open(self.dir_base + '/templates/field_names.txt') as field_names:
-            for line in field_names:
-                p = Paragraph(line, self.styles['BodyText'])
-                self.Story.append(p)
-
+        self.add_template('field_names')
         self.Story.append(PageBreak())
 
-        with open(self.dir_base + '/templates/notes.txt') as field_names:
-            for line in field_names:
-                p = Paragraph(line, self.styles['BodyText'])
-                self.Story.append(p)
-
+        self.add_template('notes')
         self.Story.append(PageBreak())
 
-        with open(self.dir_base + '/templates/aid_data.txt') as field_names:
-            for line in field_names:
-                p = Paragraph(line, self.styles['BodyText'])
-                self.Story.append(p)
+        self.add_template('aid_data')
 
 
 
@@ -226,13 +403,7 @@ class DocBuilder():
         ]
 
         data = [[i[0], pg(i[1], 1)] for i in data]
-        t = Table(data)
-        t.setStyle(TableStyle([
-            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-            ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-        ]))
-
-        self.Story.append(t)
+        self.Story.append(label_table(data))
         self.Story.append(Spacer(1, 0.25*inch))
 
         # ----------------------------------------
@@ -274,13 +445,7 @@ class DocBuilder():
                     data.append([f, ', '.join([i.encode('ascii', 'ignore') for i in dset['filters'][f]])])
 
             data = [[i[0], pg(i[1], 2)] for i in data]
-            t = Table(data)
-            t.setStyle(TableStyle([
-                ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-                ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-            ]))
-
-            self.Story.append(t)
+            self.Story.append(label_table(data))
             self.Story.append(Spacer(1, 0.25*inch))
 
 
@@ -292,18 +457,15 @@ class DocBuilder():
             self.Story.append(Spacer(1, 0.05*inch))
 
 
-            colnames_list =  [
-                '{0}.{1}.{2}'.format(dset['name'], i, j)
-                for i in [f['name'].split('_')[-1] for f in dset['files']]
-                for j in dset['options']['extract_types']
-            ]
+            column_count = (len(dset['files']) *
+                            len(dset['options']['extract_types']))
 
             colnames = ('Format: "{0}.&lt;temporal&gt;.&lt;method&gt;" <br /> '
                         'for all combinations of &lt;temporal&gt; and &lt;method&gt; '
                         'which can be found in the "Temporal Selection" and '
                         '"Extract Types Selected" fields below '
                         '({1} columns total)').format(
-                            dset['name'], len(colnames_list)
+                            dset['name'], column_count
                         )
 
             data = [
@@ -319,23 +481,18 @@ class DocBuilder():
             if 'none' in temporal_raw:
                 temporal_str = temporal_raw
             else:
-                temporal_int = [int(s) for s in temporal_raw]
-                temporal_sorted = sorted(temporal_int, reverse=True)
-                temporal_str = [str(ts) for ts in temporal_sorted]
+                temporal_str = compact_temporal(temporal_raw)
 
-            data.append(['Temporal Selection', ', '.join(temporal_str)])
+            for ix in range(0, max(len(temporal_str), 1), TEMPORAL_ROW_SIZE):
+                label = 'Temporal Selection' if ix == 0 else ''
+                data.append([label, ', '.join(
+                    temporal_str[ix:ix+TEMPORAL_ROW_SIZE])])
 
             data.append(['Extract Types Selected', ', '.join(dset['options']['extract_types'])])
 
 
             data = [[i[0], pg(i[1], 1)] for i in data]
-            t = Table(data)
-            t.setStyle(TableStyle([
-                ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-                ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-            ]))
-
-            self.Story.append(t)
+            self.Story.append(label_table(data))
             self.Story.append(Spacer(1, 0.25*inch))
 
 
@@ -344,7 +501,7 @@ class DocBuilder():
     def build_meta(self, name, item_type):
 
         # get metadata for dataset from asdf->data collection
-        meta = self.c_asdf.find_one({'name': name})
+        meta = self.meta_cache.get(self.c_asdf, name)
 
         if meta is None:
             msg = ('Could not lookup dataset ({0}, {1}) for '
@@ -437,6 +594,40 @@ class DocBuilder():
         return data
 
 
+    def add_meta_table(self, name, item_type):
+        """add meta table for dataset
+
+        table rows (including paragraphs) are cached by dataset name,
+        type and the date the dataset was last updated, so they are only
+        built once for datasets used by many requests and rebuilt when
+        the dataset is updated
+        """
+        meta = self.meta_cache.get(self.c_asdf, name)
+
+        key = None
+        if meta is not None:
+            key = (name, item_type, meta['asdf']['date_updated'])
+
+        with meta_fragments_lock:
+            rows = meta_fragments.pop(key, None)
+            if rows is not None:
+                # reinsert to mark as most recently used
+                meta_fragments[key] = rows
+
+        if rows is None:
+            # build meta table array
+            data = self.build_meta(name, item_type)
+            rows = [[i[0], pg(i[1], 2)] for i in data]
+
+            with meta_fragments_lock:
+                meta_fragments[key] = rows
+                while len(meta_fragments) > META_FRAGMENTS_MAX:
+                    meta_fragments.popitem(last=False)
+
+        self.Story.append(label_table([list(row) for row in rows]))
+        self.Story.append(Spacer(1, 0.25*inch))
+
+
     def add_meta(self):
 
         ptext = '<b><font size=14>Meta Information</font></b>'
@@ -449,18 +640,7 @@ class DocBuilder():
         self.Story.append(Spacer(1, 0.05*inch))
 
 
-        # build boundary meta table array
-        data = self.build_meta(self.request['boundary']['name'], 'boundary')
-
-        data = [[i[0], pg(i[1], 2)] for i in data]
-        t = Table(data)
-        t.setStyle(TableStyle([
-            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-            ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-        ]))
-
-        self.Story.append(t)
-        self.Story.append(Spacer(1, 0.25*inch))
+        self.add_meta_table(self.request['boundary']['name'], 'boundary')
 
 
         # full dataset meta
@@ -475,18 +655,7 @@ class DocBuilder():
                 self.Story.append(Paragraph(ptext, self.styles['Normal']))
                 self.Story.append(Spacer(1, 0.05*inch))
 
-                # build dataset meta table array
-                data = self.build_meta(dset['dataset'], 'release')
-
-                data = [[i[0], pg(i[1], 2)] for i in data]
-                t = Table(data)
-                t.setStyle(TableStyle([
-                    ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-                    ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-                ]))
-
-                self.Story.append(t)
-                self.Story.append(Spacer(1, 0.25*inch))
+                self.add_meta_table(dset['dataset'], 'release')
 
 
         for dset in self.request['raster_data']:
@@ -498,18 +667,7 @@ class DocBuilder():
                 self.Story.append(Paragraph(ptext, self.styles['Normal']))
                 self.Story.append(Spacer(1, 0.05*inch))
 
-                # build dataset meta table array
-                data = self.build_meta(dset['name'], dset['type'])
-
-                data = [[i[0], pg(i[1], 2)] for i in data]
-                t = Table(data)
-                t.setStyle(TableStyle([
-                    ('INNERGRID', (0,0), (-1,-1), 0.25, colors.black),
-                    ('BOX', (0,0), (-1,-1), 0.25, colors.black)
-                ]))
-
-                self.Story.append(t)
-                self.Story.append(Spacer(1, 0.25*inch))
+                self.add_meta_table(dset['name'], dset['type'])
 
 
 
@@ -518,10 +676,7 @@ class DocBuilder():
     # license stuff
     def add_additional(self):
 
-        with open(self.dir_base + '/templates/additional.txt') as license:
-            for line in license:
-                p = Paragraph(line, self.styles['BodyText'])
-                self.Story.append(p)
+        self.add_template('additional')
 
 
 
@@ -8,10 +8,17 @@ class ExtractItem():
     """check status of item in extract queue
     """
     def __init__(self, client, base, boundary, dataset, data,
-                 extract_type, temporal_type, version):
+                 extract_type, temporal_type, version, file_index=None,
+                 status_cache=None):
 
         self.client = client
 
+        # optional FileIndex used to check files
+        self.file_index = file_index
+
+        # optional StatusCache shared by items in processing pass
+        self.status_cache = status_cache
+
         self.c_extracts = self.client.asdf.extracts
         self.c_msr = self.client.asdf.msr
 
@@ -56,7 +63,27 @@ class ExtractItem():
         else:
             raise Exception('invalid extract type')
 
-        self.extract_path = None
+        # queue collection and fields identifying item in it
+        # (last field is the one which varies most between items
+        # so items can be looked up in bulk using $in)
+        self.collection = self.c_extracts
+        self.key_fields = ('boundary', 'extract_type', 'version', 'data')
+        self.key = (self.boundary, self.extract_type, self.version, self.data)
+
+        temporal = self.temporal_type
+        if temporal in ["None", None, "na", '']:
+            temporal = "na"
+
+        # full file name
+        output_name = '{0}.{1}.{2}.csv'.format(self.dataset,
+                                               temporal,
+                                               self.extract_type)
+
+        # absolute output path
+        # need as attribute so it can be added to merge list
+        # outside class instance
+        self.extract_path = os.path.join(
+            self.base, self.boundary, "cache", self.dataset, output_name)
 
 
     def __exists_in_db(self):
@@ -84,24 +111,12 @@ class ExtractItem():
     def __exists_in_file(self):
         """check if extract file exists
         """
-        temporal = self.temporal_type
-        if temporal in ["None", None, "na", '']:
-            temporal = "na"
-
-        # full file name
-        output_name = '{0}.{1}.{2}.csv'.format(self.dataset,
-                                               temporal,
-                                               self.extract_type)
+        extract_path = self.extract_path
 
-        # absolute output path
-        extract_path = os.path.join(
-            self.base, self.boundary, "cache", self.dataset, output_name)
-
-        # need as attribute so it can be added to merge list
-        # outside class instance
-        self.extract_path = extract_path
-
-        extract_exists = os.path.isfile(extract_path) and os.stat(extract_path).st_size > 0
+        if self.file_index is not None:
+            extract_exists = self.file_index.nonempty(extract_path)
+        else:
+            extract_exists = os.path.isfile(extract_path) and os.stat(extract_path).st_size > 0
 
         # print 'extract file info'
         # print extract_path
@@ -117,10 +132,32 @@ class ExtractItem():
         - check if extract is completed, waiting to be run, or
            encountered an error
         """
+        if self.status_cache is not None:
+            cached_status = self.status_cache.get(self)
+            if cached_status is not None:
+                return cached_status
+
         db_exists, db_status = self.__exists_in_db()
 
-        file_exists = self.__exists_in_file()
+        status = self.evaluate(db_exists, db_status)
+
+        if self.status_cache is not None:
+            self.status_cache.set(self, status)
+
+        return status
+
+
+    def evaluate(self, db_exists, db_status):
+        """get extract status from result of db lookup
 
+        file is only checked when db says extract is completed
+
+        Args
+            db_exists (bool): extract exists in extract queue
+            db_status (int): status of extract in extract queue
+        Returns
+            tuple (valid_exists, valid_completed)
+        """
         valid_exists = False
         valid_completed = False
 
@@ -131,7 +168,7 @@ class ExtractItem():
 
             elif db_status == 1:
 
-                if file_exists:
+                if self.__exists_in_file():
                     valid_exists = True
                     valid_completed = True
 
@@ -143,8 +180,12 @@ class ExtractItem():
         return valid_exists, valid_completed
 
 
-    def add_to_queue(self, classification):
-        """add extract item to asdf->extracts mongodb collection
+    def queue_update(self, classification):
+        """get upsert which adds extract item to asdf->extracts
+        mongodb collection (or updates existing item)
+
+        Returns
+            tuple (collection, query, update)
         """
         ctime = int(time.time())
 
@@ -162,24 +203,30 @@ class ExtractItem():
             'update_time': ctime
         }
 
-        full_insert = query.copy()
-        full_insert.update(details)
+        update = {
+            '$set': details,
+            '$setOnInsert': {
+                'status': 0,
+                'submit_time': ctime
+            }
+        }
+
+        return self.c_extracts, query, update
+
 
-        # check if exists
-        search = self.c_extracts.find_one(query)
+    def add_to_queue(self, classification):
+        """add extract item to asdf->extracts mongodb collection
 
-        if search is not None:
-            # if search['status'] == 0 and search['priority'] < 0:
+        items already added in current processing pass are skipped
+        """
+        if self.status_cache is not None and self.status_cache.is_queued(self):
+            return True, None
 
-            # update priority
-            update = self.c_extracts.update(query,
-                                            {'$set': details})
-        else:
-            full_insert['status'] = 0
-            full_insert['submit_time'] = ctime
+        collection, query, update = self.queue_update(classification)
 
-            # insert full
-            insert = self.c_extracts.insert(full_insert)
+        collection.update(query, update, upsert=True)
 
-        return True, ctime
+        if self.status_cache is not None:
+            self.status_cache.set_queued(self)
 
+        return True, update['$set']['update_time']
@@ -0,0 +1,117 @@
+
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+# rows read at a time when extracts are read in chunks but no chunk size
+# is given (e.g. when creating sidecars)
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def read_csv_chunks(path, usecols=None, chunk_size=None, dtypes=None):
+    """open extract csv as an iterator over chunks of rows
+
+    types of columns are inferred separately for each chunk, except for
+    columns given in dtypes
+
+    Args
+        path (str): path of extract csv
+        usecols (list): columns to read (all columns if None)
+        chunk_size (int): rows per chunk
+        dtypes (dict): {column: dtype} to pass to read_csv
+    Returns
+        pandas TextFileReader
+    """
+    return pd.read_csv(path, quotechar='\"', na_values='',
+                       keep_default_na=False, usecols=usecols,
+                       dtype=dtypes, chunksize=chunk_size)
+
+
+def merged_dtype(old_dtype, new_dtype):
+    """get type of a column read as a single table, given its type in
+    two chunks
+
+    read_csv infers the type of each column separately for every chunk
+    when reading in chunks, so an int column with a blank value after the
+    first chunk is read as int in the first chunk and as float after it
+    (and would be written as 55 and 55.0). reading the whole file at once
+    gives float for every row
+
+    Returns
+        numpy dtype, None if the column is not numeric in both chunks
+        (types of non numeric columns are left to read_csv)
+    """
+    if old_dtype.kind in 'iuf' and new_dtype.kind in 'iuf':
+        return np.result_type(old_dtype, new_dtype)
+    return None
+
+
+def chunk_dtypes(chunks):
+    """get types columns have when chunks are read as a single table
+
+    only numeric columns whose type differs between chunks are returned,
+    see merged_dtype
+
+    Args
+        chunks (iterator): dataframes read from an extract csv
+    Returns
+        tuple ({column: dtype} to pass to read_csv, number of rows)
+    """
+    # column -> type so far (None if column is not numeric in every chunk)
+    dtypes = {}
+    mixed = set()
+    rows = 0
+
+    for chunk in chunks:
+        rows += len(chunk)
+        for c in chunk.columns:
+            if c not in dtypes:
+                dtypes[c] = chunk[c].dtype
+            elif dtypes[c] is not None and chunk[c].dtype != dtypes[c]:
+                mixed.add(c)
+                dtypes[c] = merged_dtype(dtypes[c], chunk[c].dtype)
+
+    fixed = {}
+    for c in mixed:
+        if dtypes[c] is not None:
+            fixed[c] = dtypes[c]
+
+    return fixed, rows
+
+
+def read_extract_chunks(path, usecols=None, chunk_size=None):
+    """read extract csv in chunks of rows
+
+    types of columns are the same in every chunk, and the same as when
+    the whole file is read. files which fit in a single chunk (most
+    boundaries) are only read once. larger files are read once to find
+    the type of each column in the whole file (see chunk_dtypes) and then
+    read again with those types
+
+    Args
+        path (str): path of extract csv
+        usecols (list): columns to read (all columns if None)
+        chunk_size (int): rows per chunk. whole file is read as a single
+                          chunk if None
+    Returns
+        iterator of dataframes
+    """
+    if chunk_size is None:
+        return iter([pd.read_csv(path, quotechar='\"', na_values='',
+                                 keep_default_na=False, usecols=usecols)])
+
+    reader = read_csv_chunks(path, usecols, chunk_size)
+
+    first = next(reader, None)
+
+    if first is None or len(first) < chunk_size:
+        # whole file is in first chunk
+        reader.close()
+        return iter([first] if first is not None else [])
+
+    dtypes, rows = chunk_dtypes(itertools.chain([first], reader))
+
+    return read_csv_chunks(path, usecols, chunk_size, dtypes)
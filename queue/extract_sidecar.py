@@ -0,0 +1,247 @@
+
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from extract_reader import read_csv_chunks, merged_dtype, DEFAULT_CHUNK_SIZE
+
+
+class ExtractSidecar():
+    """binary copy of extract csv columns stored next to extract csv
+
+    columns are stored as raw binary files in a directory next to the
+    extract csv (<dataset>.<temporal>.<type>.columns for
+    <dataset>.<temporal>.<type>.csv) so they can be memory mapped
+    when merging instead of parsing the csv again
+
+    the sidecar records the size and mtime of the csv it was made from
+    and is ignored if the csv has changed. sidecars are created lazily
+    (the first time an extract is merged) and failures to create them
+    are ignored, since the extract cache may not be writable
+
+    Args
+        extract_path (str): path of extract csv
+        path (str): path of sidecar directory, defaults to directory next
+                    to extract csv (used to create temporary sidecars
+                    for extracts in caches which are not writable)
+    """
+    # increment if format of sidecar changes
+    format_version = 2
+
+    def __init__(self, extract_path, path=None):
+        self.extract_path = extract_path
+
+        if path is None:
+            path = os.path.splitext(extract_path)[0] + '.columns'
+        self.path = path
+        self.meta_path = os.path.join(self.path, 'meta.json')
+
+
+    def __csv_info(self):
+        extract_stat = os.stat(self.extract_path)
+        return extract_stat.st_size, extract_stat.st_mtime
+
+
+    def load(self, columns):
+        """load columns from sidecar
+
+        Args
+            columns (list): names of columns to load
+        Returns
+            (list) (column name, memory mapped array) tuples in same
+            order as columns, None if sidecar does not exist, is out of
+            date or does not have all columns
+        """
+        try:
+            with open(self.meta_path) as meta_file:
+                meta = json.load(meta_file)
+
+            csv_size, csv_mtime = self.__csv_info()
+
+        except (IOError, OSError, ValueError):
+            return None
+
+        if (meta.get('format_version') != self.format_version
+                or meta.get('csv_size') != csv_size
+                or meta.get('csv_mtime') != csv_mtime):
+            return None
+
+        files = dict((c, (column_file, dtype))
+                     for c, column_file, dtype in meta['columns'])
+
+        if any(c not in files for c in columns):
+            return None
+
+        rows = meta['rows']
+
+        arrays = []
+        try:
+            for c in columns:
+                column_file, dtype = files[c]
+                column_path = os.path.join(self.path, column_file)
+                dtype = np.dtype(str(dtype))
+
+                if os.path.getsize(column_path) != rows * dtype.itemsize:
+                    return None
+
+                arrays.append((c, np.memmap(column_path, dtype=dtype,
+                                            mode='r', shape=(rows,))))
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+
+        return arrays
+
+
+    def create(self, columns, chunk_size=None):
+        """create sidecar from columns of extract csv
+
+        csv is read once, in chunks, and each chunk is appended to the
+        column files, so memory use is bounded by the chunk size. only
+        numeric columns are saved. if a column has a different type in a
+        later chunk (e.g. an int column with a blank value), rows already
+        written are converted to the type of the whole column (see
+        merged_dtype). sidecar is written to a temporary directory and
+        moved into place so partially written sidecars are never read
+
+        Args
+            columns (list): names of columns to read from extract csv
+            chunk_size (int): rows read from csv at a time
+        Returns
+            (bool) whether sidecar was created
+        """
+        if chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+
+        tmp_path = None
+        try:
+            csv_size, csv_mtime = self.__csv_info()
+
+            parent = os.path.dirname(self.path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            tmp_path = tempfile.mkdtemp(prefix='.tmp_columns_', dir=parent)
+
+            # [column name, file name, dtype] of numeric columns
+            files = None
+
+            rows = 0
+
+            for chunk in read_csv_chunks(self.extract_path, columns,
+                                         chunk_size):
+
+                if files is None:
+                    numeric = [c for c in chunk.columns
+                               if np.issubdtype(chunk[c].dtype, np.number)]
+
+                    if len(numeric) == 0:
+                        return False
+
+                    files = [[c, '{0}.bin'.format(ix), chunk[c].dtype]
+                             for ix, c in enumerate(numeric)]
+
+                for column in files:
+                    c, column_file, dtype = column
+                    column_path = os.path.join(tmp_path, column_file)
+
+                    chunk_dtype = merged_dtype(dtype, chunk[c].dtype)
+
+                    if chunk_dtype is None:
+                        # column is not numeric in every chunk
+                        return False
+
+                    if chunk_dtype != dtype:
+                        convert_column(column_path, dtype, chunk_dtype,
+                                       rows, chunk_size)
+                        column[2] = chunk_dtype
+
+                    with open(column_path, 'ab') as column_data:
+                        chunk[c].values.astype(chunk_dtype).tofile(column_data)
+
+                rows += len(chunk)
+
+            if files is None:
+                return False
+
+            meta = {
+                'format_version': self.format_version,
+                'csv_size': csv_size,
+                'csv_mtime': csv_mtime,
+                'rows': rows,
+                'columns': [[c, column_file, dtype.str]
+                            for c, column_file, dtype in files]
+            }
+
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+                json.dump(meta, meta_file)
+
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path, ignore_errors=True)
+
+            os.rename(tmp_path, self.path)
+            tmp_path = None
+
+        except (IOError, OSError, ValueError):
+            return False
+
+        finally:
+            if tmp_path is not None:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        return True
+
+
+def convert_column(column_path, old_dtype, new_dtype, rows, chunk_size):
+    """convert type of values in column file
+
+    values are converted a chunk of rows at a time into a new file, which
+    replaces the column file
+
+    Args
+        column_path (str): path of raw binary column file
+        old_dtype (dtype): type of values in file
+        new_dtype (dtype): type to convert values to
+        rows (int): number of values in file
+        chunk_size (int): values converted at a time
+    """
+    old_values = np.memmap(column_path, dtype=old_dtype, mode='r',
+                           shape=(rows,))
+
+    tmp_path = column_path + '.tmp'
+
+    with open(tmp_path, 'wb') as column_data:
+        for ix in range(0, rows, chunk_size):
+            old_values[ix:ix+chunk_size].astype(new_dtype).tofile(column_data)
+
+    del old_values
+
+    os.rename(tmp_path, column_path)
+
+
+def iter_sidecar_chunks(arrays, chunk_size=None):
+    """iterate over columns loaded from sidecar in chunks of rows
+
+    only the rows in each chunk are read from the memory mapped arrays
+
+    Args
+        arrays (list): (column name, array) tuples from ExtractSidecar.load
+        chunk_size (int): number of rows per chunk. all rows are returned
+                          as a single chunk if None
+    """
+    columns = [c for c, array in arrays]
+    rows = len(arrays[0][1])
+
+    if chunk_size is None:
+        yield pd.DataFrame(dict(arrays), columns=columns)
+        return
+
+    for ix in range(0, rows, chunk_size):
+        yield pd.DataFrame(
+            dict((c, np.asarray(array[ix:ix+chunk_size]))
+                 for c, array in arrays),
+            columns=columns)
@@ -0,0 +1,136 @@
+
+
+import os
+import stat
+import time
+
+# scandir is in os for python 3.5+, otherwise use the scandir package
+# (falls back to listdir if it is not installed)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class FileIndex():
+    """index of file sizes for directories in extract/msr caches
+
+    each directory is listed once and existence checks for files in the
+    directory are answered from the listing, instead of calling isfile
+    for every item. only files whose size is needed are stat'ed (once,
+    sizes of non empty files are kept until the directory changes).
+
+    a directory is rescanned when its mtime changes. the mtime is only
+    checked once per processing pass (see new_pass), so a pass does one
+    stat per directory regardless of how many items are checked
+    """
+    def __init__(self):
+        # dir path -> (mtime, scan time, {file name: size or None})
+        self.dirs = {}
+
+        # dirs whose mtime has been checked in current pass
+        self.checked = set()
+
+
+    def new_pass(self):
+        """start new processing pass
+
+        directories will be checked for changes on next access
+        """
+        self.checked = set()
+
+
+    def __scan(self, path):
+        """list names in directory
+
+        sizes are not known until needed (see size). without scandir
+        the listing may include subdirectories, which size excludes
+
+        Returns
+            (dict) name -> None
+        """
+        if scandir is not None:
+            return {entry.name: None for entry in scandir(path)
+                    if entry.is_file()}
+
+        return dict.fromkeys(os.listdir(path))
+
+
+    def __get_dir(self, path):
+        """get index for directory, scanning directory if it is new or
+        has changed
+
+        Returns
+            (dict) file name -> size (None if not stat'ed yet), None if
+                   directory does not exist
+        """
+        if path in self.checked:
+            info = self.dirs.get(path)
+            return info[2] if info is not None else None
+
+        self.checked.add(path)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.dirs.pop(path, None)
+            return None
+
+        info = self.dirs.get(path)
+
+        # mtime resolution may be coarse, so do not trust an index made
+        # within a couple seconds of the last change to the directory
+        if info is None or info[0] != mtime or info[1] - mtime < 2:
+            scan_time = time.time()
+            try:
+                files = self.__scan(path)
+            except OSError:
+                self.dirs.pop(path, None)
+                return None
+            info = (mtime, scan_time, files)
+            self.dirs[path] = info
+
+        return info[2]
+
+
+    def size(self, path):
+        """get size of file
+
+        Returns
+            (int) size of file, None if file does not exist
+        """
+        dir_path, name = os.path.split(path)
+
+        files = self.__get_dir(dir_path)
+
+        if files is None or name not in files:
+            return None
+
+        size = files[name]
+
+        # empty files are checked again, since a file may have been
+        # created empty and written to later, which does not change the
+        # mtime of the directory
+        if not size:
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                return None
+
+            if not stat.S_ISREG(file_stat.st_mode):
+                return None
+
+            size = file_stat.st_size
+            files[name] = size
+
+        return size
+
+
+    def nonempty(self, path):
+        """check if file exists and is not empty
+        """
+        size = self.size(path)
+        return size is not None and size > 0
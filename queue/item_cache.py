@@ -0,0 +1,178 @@
+
+
+import os
+import errno
+import json
+import time
+import sqlite3
+
+
+class CompletionStore():
+    """on disk record of completed extract/msr items
+
+    completed items (extract csv / msr files exist and item has status 1
+    in its queue) do not change for a given version, so once an item is
+    found to be completed it is recorded here and never looked up in the
+    db or filesystem again. items are identified by their queue collection
+    and key (which includes the extract version, or the msr hash which
+    includes the msr version)
+
+    uses a local sqlite file, which should not be on a shared filesystem
+    """
+    def __init__(self, path):
+        self.path = path
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS completed '
+                          '(item_id TEXT PRIMARY KEY, time INTEGER)')
+        self.conn.commit()
+
+
+    def item_id(self, item):
+        return json.dumps([item.collection.full_name] + list(item.key))
+
+
+    def find(self, items):
+        """get items which are recorded as completed
+
+        Returns
+            (set) ids of completed items
+        """
+        ids = list(set(self.item_id(item) for item in items))
+
+        found = set()
+
+        # sqlite limits number of variables in a query
+        chunk_size = 500
+        for ix in range(0, len(ids), chunk_size):
+            chunk = ids[ix:ix+chunk_size]
+            query = ('SELECT item_id FROM completed WHERE item_id IN '
+                     '({0})').format(','.join('?' * len(chunk)))
+            found.update(row[0] for row in self.conn.execute(query, chunk))
+
+        return found
+
+
+    def add(self, items):
+        """record items as completed
+        """
+        ctime = int(time.time())
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO completed (item_id, time) VALUES (?, ?)',
+            [(self.item_id(item), ctime) for item in items])
+        self.conn.commit()
+
+
+class StatusCache():
+    """status of extract/msr items checked during a processing pass
+
+    shared by all requests in a pass so an item used by multiple
+    requests (same boundary and data) is only checked and added to its
+    queue once per pass. items are identified by their queue collection
+    and key
+
+    if a CompletionStore is given, items recorded as completed in previous
+    passes are not checked again, and newly completed items are added to it
+    """
+    def __init__(self, completion_store=None):
+        self.completion_store = completion_store
+
+        # item id -> (exists, completed)
+        self.status = {}
+
+        # ids of items added to queue in this pass
+        self.queued = set()
+
+        # ids of items already looked up in completion store in this pass
+        self.loaded = set()
+
+
+    def clear(self):
+        """clear cache at start of new processing pass
+        """
+        self.status = {}
+        self.queued = set()
+        self.loaded = set()
+
+
+    def item_id(self, item):
+        return (item.collection.full_name,) + tuple(item.key)
+
+
+    def load(self, items):
+        """load status of completed items from completion store
+
+        avoids a separate completion store lookup for each item
+        """
+        if self.completion_store is None:
+            return
+
+        unchecked = [item for item in items
+                     if self.item_id(item) not in self.status
+                     and self.item_id(item) not in self.loaded]
+
+        if len(unchecked) == 0:
+            return
+
+        completed = self.completion_store.find(unchecked)
+
+        for item in unchecked:
+            self.loaded.add(self.item_id(item))
+            if self.completion_store.item_id(item) in completed:
+                self.status[self.item_id(item)] = (True, True)
+
+
+    def get(self, item):
+        """get cached status of item
+
+        Returns
+            tuple (exists, completed) or None if item has not been checked
+        """
+        self.load([item])
+
+        return self.status.get(self.item_id(item))
+
+
+    def set(self, item, status):
+        """cache status of item
+
+        Args
+            status (tuple): (exists, completed)
+        """
+        self.set_many([item], [status])
+
+
+    def set_many(self, items, status_list):
+        """cache status of items
+
+        Args
+            status_list (list): (exists, completed) tuple for each item
+        """
+        completed = []
+        for item, status in zip(items, status_list):
+            self.status[self.item_id(item)] = status
+            if status[1] == True:
+                completed.append(item)
+
+        if self.completion_store is not None and len(completed) > 0:
+            self.completion_store.add(completed)
+
+
+    def is_queued(self, item):
+        """check if item has already been added to queue in this pass
+        """
+        return self.item_id(item) in self.queued
+
+
+    def set_queued(self, item):
+        """mark item as added to queue (exists, not completed)
+        """
+        item_id = self.item_id(item)
+        self.queued.add(item_id)
+        self.status[item_id] = (True, False)
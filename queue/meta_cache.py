@@ -0,0 +1,110 @@
+
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class MetaCache():
+    """cache of dataset metadata documents (asdf->data collection)
+
+    shared by DocBuilder instances so metadata for datasets used by
+    many requests is not looked up for every request. metadata for all
+    datasets in one or more requests can be loaded with a single query
+    (see prefetch)
+
+    entries expire after ttl seconds, and the least recently used entries
+    are removed when the cache has more than max_size entries
+    """
+    def __init__(self, ttl=60*10, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # (collection name, dataset name) -> (load time, metadata document)
+        self.entries = OrderedDict()
+
+        self.lock = threading.Lock()
+
+
+    def __get_entry(self, key):
+        """get cached document, None if not cached or expired
+        """
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            return None
+
+        if time.time() - entry[0] > self.ttl:
+            return None
+
+        # reinsert to mark as most recently used
+        self.entries[key] = entry
+        return entry[1]
+
+
+    def __set_entry(self, key, meta):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), meta)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+    def get(self, collection, name):
+        """get metadata document for dataset
+
+        Returns
+            (dict) metadata document, None if dataset does not exist
+        """
+        key = (collection.full_name, name)
+
+        with self.lock:
+            meta = self.__get_entry(key)
+
+        if meta is not None:
+            return meta
+
+        meta = collection.find_one({'name': name})
+
+        if meta is not None:
+            with self.lock:
+                self.__set_entry(key, meta)
+
+        return meta
+
+
+    def prefetch(self, collection, names):
+        """load metadata for datasets which are not cached using a single
+        query
+        """
+        with self.lock:
+            missing = [name for name in set(names)
+                       if self.__get_entry((collection.full_name, name)) is None]
+
+        if len(missing) == 0:
+            return
+
+        results = list(collection.find({'name': {'$in': missing}}))
+
+        with self.lock:
+            for meta in results:
+                self.__set_entry((collection.full_name, meta['name']), meta)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+
+def request_meta_names(request):
+    """get names of all datasets (and boundary) which have metadata in
+    documentation for request
+    """
+    names = [request['boundary']['name']]
+    names += [dset['dataset'] for dset in request['release_data']]
+    names += [dset['name'] for dset in request['raster_data']]
+    return names
+
+
+# cache shared by all DocBuilder instances in process
+shared_meta_cache = MetaCache()
@@ -7,8 +7,15 @@ import time
 class MSRItem():
     """check status of item in msr queue
     """
-    def __init__(self, client, base, data_hash, selection):
+    def __init__(self, client, base, data_hash, selection, file_index=None,
+                 status_cache=None):
         self.client = client
+
+        # optional FileIndex used to check files
+        self.file_index = file_index
+
+        # optional StatusCache shared by items in processing pass
+        self.status_cache = status_cache
         self.c_msr = self.client.asdf.msr
 
         self.base = base
@@ -18,6 +25,11 @@ class MSRItem():
         self.selection = selection
         self.dataset_name = selection['dataset']
 
+        # queue collection and fields identifying item in it
+        self.collection = self.c_msr
+        self.key_fields = ('dataset', 'hash')
+        self.key = (self.dataset_name, self.data_hash)
+
 
     def __exists_in_db(self):
 
@@ -44,9 +56,14 @@ class MSRItem():
         geojson_path = msr_base + '/unique.geojson'
         summary_path = msr_base + '/summary.json'
 
-        raster_exists = os.path.isfile(raster_path) and os.stat(raster_path).st_size > 0
-        geojson_exists = os.path.isfile(geojson_path) and os.stat(geojson_path).st_size > 0
-        summary_exists = os.path.isfile(summary_path) and os.stat(summary_path).st_size > 0
+        if self.file_index is not None:
+            raster_exists = self.file_index.nonempty(raster_path)
+            geojson_exists = self.file_index.nonempty(geojson_path)
+            summary_exists = self.file_index.nonempty(summary_path)
+        else:
+            raster_exists = os.path.isfile(raster_path) and os.stat(raster_path).st_size > 0
+            geojson_exists = os.path.isfile(geojson_path) and os.stat(geojson_path).st_size > 0
+            summary_exists = os.path.isfile(summary_path) and os.stat(summary_path).st_size > 0
 
         msr_exists = raster_exists and geojson_exists and summary_exists
 
@@ -61,12 +78,32 @@ class MSRItem():
         2) check if msr is completed, waiting to be run, or encountered
            an error
         """
+        if self.status_cache is not None:
+            cached_status = self.status_cache.get(self)
+            if cached_status is not None:
+                return cached_status
+
         db_exists, db_status = self.__exists_in_db()
 
-        (file_exists, file_raster_exists,
-         file_geojson_exists, file_summary_exists) = self.__exists_in_file()
+        status = self.evaluate(db_exists, db_status)
 
+        if self.status_cache is not None:
+            self.status_cache.set(self, status)
 
+        return status
+
+
+    def evaluate(self, db_exists, db_status):
+        """get msr status from result of db lookup
+
+        files are only checked when db says msr is completed
+
+        Args
+            db_exists (bool): msr exists in msr tracker
+            db_status (int): status of msr in msr tracker
+        Returns
+            tuple (valid_exists, valid_completed)
+        """
         valid_exists = False
         valid_completed = False
 
@@ -77,7 +114,7 @@ class MSRItem():
 
             elif db_status== 1:
 
-                if file_exists:
+                if self.__exists_in_file()[0]:
                     valid_exists = True
                     valid_completed = True
 
@@ -93,8 +130,12 @@ class MSRItem():
         return valid_exists, valid_completed
 
 
-    def add_to_queue(self):
-        """add msr item to det->msr mongodb collection
+    def queue_update(self):
+        """get upsert which adds msr item to det->msr mongodb collection
+        (or updates existing item)
+
+        Returns
+            tuple (collection, query, update)
         """
         ctime = int(time.time())
 
@@ -110,25 +151,30 @@ class MSRItem():
             'update_time': ctime
         }
 
-        full_insert = query.copy()
-        full_insert.update(details)
+        update = {
+            '$set': details,
+            '$setOnInsert': {
+                'status': 0,
+                'submit_time': ctime
+            }
+        }
 
-        # check if exists
-        search = self.c_msr.find_one(query)
+        return self.c_msr, query, update
 
-        if search is not None:
-             # if search['status'] == 0 and search['priority'] < 0:
 
-            # update priority
-            update = self.c_msr.update(query,
-                                       {'$set': details})
-        else:
+    def add_to_queue(self):
+        """add msr item to det->msr mongodb collection
+
+        items already added in current processing pass are skipped
+        """
+        if self.status_cache is not None and self.status_cache.is_queued(self):
+            return True, None
 
-            full_insert['status'] = 0
-            full_insert['submit_time'] = ctime
+        collection, query, update = self.queue_update()
 
-            # insert full
-            insert = self.c_msr.insert(full_insert)
+        collection.update(query, update, upsert=True)
 
-        return True, ctime
+        if self.status_cache is not None:
+            self.status_cache.set_queued(self)
 
+        return True, update['$set']['update_time']
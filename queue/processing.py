@@ -2,6 +2,50 @@
 
 called by cronjob on server for branch
 
+when run with multiple processors (mpirun), rank 0 gets the requests in
+the queue and hands them out to the other ranks. each worker rank is seeded
+with a static share of the queue and then pulls one request at a time from
+rank 0 as it finishes, so long running builds do not hold up the rest
+of the queue.
+
+usage:
+    python processing.py <branch> [<request_id>]
+    python processing.py <branch> full
+    python processing.py <branch> daemon
+
+waiting requests (status 0) are only checked when an extract/msr item
+they are waiting on is no longer pending (see get_woken_requests). a full
+run checks all waiting requests. as a safety net for missed wakes, cron
+runs and the daemon also do a full check every FULL_SCAN_INTERVAL
+seconds.
+
+in daemon mode the script keeps running (keeping the mongo client, config
+and mpi setup warm) and checks the queue repeatedly. it waits between
+checks using a change stream on the det collection when the database is a
+replica set, otherwise it polls with an interval that grows while the
+queue is idle. SIGTERM/SIGINT stop the daemon after the current requests
+are finished.
+
+outputs of ready requests are built in the background by a bounded pool
+of long lived build processes on each rank (det config option
+build_processes, 0 builds outputs inline), so checking other requests is
+not blocked by long builds. each build process keeps its config, mongo
+client and documentation caches between builds. the request is set to completed and the user is emailed
+when its build finishes. build_processes defaults to 1 when run on a
+single processor and 0 under mpi (forking after mpi is initialized is
+not supported by some mpi implementations/fabrics).
+
+each build can also parse extracts using a pool of processes (det config
+option merge_processes), so a rank may use up to
+build_processes * merge_processes processes while building outputs.
+
+when several requests on a rank become ready in the same pass, their
+documentation is generated together by a pool of processes (det config
+option doc_processes, see doc_batch) before their outputs are built.
+doc_processes defaults to the number of cpus when run on a single
+processor and 1 under mpi (documentation is then generated as part of
+each build).
+
 
 to do (maybe)
 
@@ -48,6 +92,8 @@ while True:
 import mpi_utility
 job = mpi_utility.NewParallel()
 
+from mpi4py import MPI
+
 
 connect_status = job.comm.gather((job.rank, config.connection_status, config.connection_error), root=0)
 
@@ -68,93 +114,198 @@ job.comm.Barrier()
 import os
 import sys
 import time
+import socket
+import signal
+import threading
+import traceback
 import warnings
+import multiprocessing
 
 # # used for logging
 # sys.stdout = sys.stderr = open(
 #     os.path.dirname(os.path.abspath(__file__)) + '/processing.log', 'a')
 
 from request_tools import QueueToolBox
+from build_pool import BuildPool
 
 # =============================================================================
 
-print '\n======================================='
-print '\nProcessing Script'
-print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
+# mpi message tags used to distribute requests from rank 0
+TAG_WORK = 1
+TAG_DONE = 2
+TAG_STOP = 3
+
+# seconds between queue checks in daemon mode. interval is doubled after
+# each check which finds no requests, up to the max
+POLL_MIN = 5
+POLL_MAX = 120
+
+# seconds between checks of all waiting requests
+FULL_SCAN_INTERVAL = 60 * 60
+
+# mtime of file is time of last full check of waiting requests by a
+# cron run (cron runs are separate processes)
+FULL_SCAN_MARKER = os.path.join(os.path.expanduser('~'), '.det', branch,
+                                'last_full_scan')
+
+
+if job.rank == 0:
+    print '\n======================================='
+    print '\nProcessing Script'
+    print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
 
 dry_run = False
 
+daemon = len(sys.argv) == 3 and sys.argv[2] == 'daemon'
+
+full_scan = len(sys.argv) == 3 and sys.argv[2] == 'full'
+
+# unique id for this worker, used to claim requests so multiple
+# workers (cron runs, branches, nodes) never process the same request
+owner = "{0}:{1}:{2}:{3}".format(socket.gethostname(), os.getpid(),
+                                 branch, job.rank)
+
 queue = QueueToolBox()
 
 # load config setting for branch script is running on
 branch_info = queue.set_branch_info(config)
-print "`{0}` branch on {1}".format(branch_info.name, branch_info.database)
 
-request_id = 0
-request_objects = []
+if job.rank == 0:
+    print "`{0}` branch on {1}".format(branch_info.name, branch_info.database)
 
-# run if given a request_id via input arg
-if len(sys.argv) == 3:
-    request_id = str(sys.argv[2])
+# processes used to build request outputs in the background on each rank
+# which processes requests (0 builds outputs inline). defaults to inline
+# builds under mpi, since forking after mpi init is not always supported
+default_build_processes = 1 if job.comm.Get_size() == 1 else 0
+build_processes = int(branch_info.det.get('build_processes',
+                                          default_build_processes))
 
-    # check for request with given id
-    # return request data object if request exists else None
-    try:
-        request_check = queue.check_id(request_id)
-    except Exception as e:
-        print "Error while checking request id (" + request_id + ")"
-        raise
+# processes used to generate documentation for requests which become
+# ready in the same pass (1 generates documentation as part of each build)
+default_doc_processes = multiprocessing.cpu_count() if job.comm.Get_size() == 1 else 1
+doc_processes = int(branch_info.det.get('doc_processes',
+                                        default_doc_processes))
 
-    if request_check is None:
-        sys.exit("Request with id does not exist (" + request_id + ")")
+# (request object, merge list, email) of requests which became ready in
+# the current pass on this rank, built by build_ready_requests
+ready_builds = []
 
-    request_objects += [request_check]
+# seconds between renewals of leases on requests being built
+lease_renew_interval = max(60, queue.lease_time // 4)
 
-else:
-    # get list of requests in queue based on status, priority and
-    # submit time
+# BuildPool, started by start_build_pool
+build_pool = None
 
-    # check for new unprocessed requests (status -1) first, before
-    # checking status of requests with items already in queue (status 0)
-    # (new requests may have items that need to be added to queue,
-    # or might already be done)
-    try:
-        request_objects += queue.get_requests(-1, 0)
-        request_objects += queue.get_requests(0, 0)
-    except Exception as e:
-            print "Error while searching for requests in queue"
+
+def get_request_objects(full_scan=False):
+    """get requests to process (only called on rank 0)
+
+    Args
+        full_scan (bool): get all waiting requests, instead of only those
+                          with items which are no longer pending
+    Returns
+        tuple (list of request objects, exit message or None)
+    """
+    request_objects = []
+
+    # run if given a request_id via input arg
+    if len(sys.argv) == 3 and not daemon and not full_scan:
+        request_id = str(sys.argv[2])
+
+        # check for request with given id
+        # return request data object if request exists else None
+        try:
+            request_check = queue.check_id(request_id)
+        except Exception as e:
+            print "Error while checking request id (" + request_id + ")"
             raise
 
-    # verify that we have some requests
-    if len(request_objects) == 0:
-       sys.exit("Request queue is empty")
+        if request_check is None:
+            return [], "Request with id does not exist (" + request_id + ")"
+
+        request_objects += [request_check]
 
+    else:
+        # get list of requests in queue based on status, priority and
+        # submit time
 
+        # check for new unprocessed requests (status -1) first, before
+        # checking status of requests with items already in queue (status 0)
+        # (new requests may have items that need to be added to queue,
+        # or might already be done)
+        try:
+            request_objects += queue.get_requests(-1, 0)
+            if full_scan:
+                request_objects += queue.get_requests(0, 0)
+            else:
+                request_objects += queue.get_woken_requests()
+            # requests claimed by workers which did not finish them
+            request_objects += queue.get_expired_requests()
+        except Exception as e:
+                print "Error while searching for requests in queue"
+                raise
+
+        # verify that we have some requests
+        if len(request_objects) == 0 and not daemon:
+           return [], "Request queue is empty"
+
+    return request_objects, None
+
+
+def full_scan_due():
+    """check if cron run should check all waiting requests
+    """
+    try:
+        last_full_scan = os.path.getmtime(FULL_SCAN_MARKER)
+    except OSError:
+        return True
 
-# go through found requests, checking status of items in
-# in extract/msr queue, building final output when ready
-# and emailing user who requested data
-for request_obj in request_objects:
+    return time.time() - last_full_scan > FULL_SCAN_INTERVAL
 
+
+def mark_full_scan():
+    """record time of full check of waiting requests by cron run
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(FULL_SCAN_MARKER)):
+            os.makedirs(os.path.dirname(FULL_SCAN_MARKER))
+        with open(FULL_SCAN_MARKER, 'a'):
+            os.utime(FULL_SCAN_MARKER, None)
+    except (IOError, OSError) as e:
+        print "unable to record full scan ({0})".format(e)
+
+
+def process_request(request_obj):
+    """check status of items for a request in extract/msr queue,
+    build final output when ready and email user who requested data
+    """
     request_id = str(request_obj['_id'])
 
     print '\n---------------------------------------'
-    print 'Request (id: {0})\n{1}\n'.format(request_id, request_obj)
+    print 'Request (id: {0}, rank: {1})\n{2}\n'.format(
+        request_id, job.rank, request_obj)
 
     if not request_obj['boundary'] or (not request_obj['release_data'] and not request_obj['raster_data']):
         queue.update_status(request_id, -2, False)
         print "Invalid request (missing key fields). Id: {0}".format(request_id)
-        continue
+        return
 
 
     print 'Boundary: {0}'.format(request_obj['boundary']['name'])
 
-    original_status = queue.get_status(request_id)
+    # claim request (sets status 2, no email)
+    claimed_request = queue.claim_request(request_obj, owner)
+
+    if claimed_request is None:
+        print "Request already claimed by another worker. Id: {0}".format(request_id)
+        return
+
+    original_status = claimed_request['lease']['status']
 
     is_prep = original_status == -1
 
-    # set status 2 (no email)
-    queue.update_status(request_id, 2, is_prep)
+    if is_prep:
+        queue.update_status(request_id, 2, is_prep, owner=owner)
 
 
 
@@ -171,6 +322,9 @@ for request_obj in request_objects:
         # send email that request was received
         queue.notify_received(request_id, request_obj['email'])
 
+        # request is not prepared again (or emailed) if it is reclaimed
+        queue.mark_received(request_id, owner)
+
 
     if missing_items == 0:
 
@@ -182,29 +336,23 @@ for request_obj in request_objects:
             raise
 
         if updated_request_obj is None:
-            sys.exit("Error getting updated request: Request with id does not exist (" + request_id + ")")
-
-
-        try:
-            # build request
-            queue.build_output(updated_request_obj, merge_list, branch)
-        except Exception as e:
-            print "error building request output"
-            queue.update_status(request_id, -2)
-            raise
-
+            raise Exception("Error getting updated request: Request with id does not exist (" + request_id + ")")
 
-        # send email that request was completed
-        queue.notify_completed(request_id, request_obj['email'])
 
-        # set status 1 (email request is ready)
-        queue.update_status(request_id, 1)
+        # extend lease to cover building output
+        if not queue.renew_lease(request_id, owner):
+            print "Lost claim on request before build. Id: {0}".format(request_id)
+            return
 
-        print "request completed"
+        # built with other requests ready in this pass
+        ready_builds.append((updated_request_obj, merge_list,
+                             request_obj['email']))
+        print "request ready"
+        return
 
     else:
         # set status 0 (no email)
-        queue.update_status(request_id, 0)
+        queue.update_status(request_id, 0, owner=owner)
 
         print "request not ready"
 
@@ -216,7 +364,442 @@ for request_obj in request_objects:
     ###
 
 
-print '\n---------------------------------------'
-print "\nFinished checking requests"
-print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
+def build_request(request_obj, merge_list, email, doc_path=None):
+    """build output of ready request (in background if there is a build
+    pool) and finish request when built
+    """
+    request_id = str(request_obj['_id'])
+
+    if build_pool is not None:
+        # build in background, build_done is called when finished
+        build_pool.submit(request_obj, merge_list, email, doc_path)
+        print "request build started (id: {0})".format(request_id)
+        return
+
+    try:
+        # build request
+        build_inline(request_obj, merge_list, doc_path)
+    except Exception as e:
+        print "error building request output"
+        queue.update_status(request_id, -2)
+        raise
+
+    finish_request(request_id, email)
+
+
+def build_ready_requests():
+    """build outputs of requests which became ready in current pass
+
+    when several requests are ready, their documentation is generated
+    first by a pool of doc_processes processes (see doc_batch) and passed
+    to their builds
+
+    every ready request is built even if a build fails. outside daemon
+    mode the first error is raised once all requests were built
+    """
+    builds = list(ready_builds)
+    del ready_builds[:]
+
+    doc_paths = {}
+
+    if len(builds) > 1 and doc_processes > 1:
+        try:
+            doc_paths = queue.build_ready_docs(
+                [request_obj for request_obj, merge_list, email in builds],
+                make_doc_client, processes=doc_processes)
+        except Exception as e:
+            # documentation is generated by each build instead
+            print "error generating documentation for ready requests"
+            traceback.print_exc()
+
+    errors = []
+
+    for request_obj, merge_list, email in builds:
+        request_id = str(request_obj['_id'])
+        try:
+            build_request(request_obj, merge_list, email,
+                          doc_paths.get(request_id))
+        except Exception as e:
+            print "error building request (id: {0})".format(request_id)
+            traceback.print_exc()
+            errors.append(e)
+
+    if errors and not daemon:
+        raise errors[0]
+
+
+def build_inline(request_obj, merge_list, doc_path=None):
+    """build output of request in current process
+
+    lease of request is renewed by a background thread while the output
+    is built (as BuildPool does for background builds), so long builds
+    are not reclaimed by another worker
+    """
+    request_id = str(request_obj['_id'])
+
+    stop_renew = threading.Event()
+
+    def renew_loop():
+        while not stop_renew.wait(lease_renew_interval):
+            try:
+                if not queue.renew_lease(request_id, owner):
+                    print "Lost claim on request during build. Id: {0}".format(request_id)
+            except Exception as e:
+                print "error renewing lease (id: {0})".format(request_id)
+                traceback.print_exc()
+
+    renew_thread = threading.Thread(target=renew_loop)
+    renew_thread.daemon = True
+    renew_thread.start()
+
+    try:
+        queue.build_output(request_obj, merge_list, branch, doc_path)
+    finally:
+        stop_renew.set()
+        renew_thread.join()
+
+
+def finish_request(request_id, email):
+    """set request as completed and email user after output is built
+    """
+    # make sure request was not reclaimed while building
+    # before sending email
+    if not queue.renew_lease(request_id, owner):
+        print "Lost claim on request during build. Id: {0}".format(request_id)
+        return
+
+    # send email that request was completed
+    queue.notify_completed(request_id, email)
+
+    # set status 1 (email request is ready)
+    queue.update_status(request_id, 1, owner=owner)
+
+    print "request completed (id: {0})".format(request_id)
+
+
+def build_done(request_id, email, error):
+    """called when background build of request output finishes
+    """
+    if error is not None:
+        print "error building request output (id: {0}): {1}".format(
+            request_id, error)
+        queue.update_status(request_id, -2)
+        return
+
+    finish_request(request_id, email)
+
+
+def load_worker_config():
+    """load branch config in a worker process (with its own client)
 
+    config is loaded with retries, as at startup, and an error is raised
+    if mongodb still can not be reached
+    """
+    worker_config_attempts = 0
+    while True:
+        worker_config = BranchConfig(branch=branch)
+        worker_config_attempts += 1
+        if worker_config.connection_status == 0:
+            break
+        if worker_config_attempts > 5:
+            raise Exception("mongodb connection error in worker process ({0} - {1})".format(
+                worker_config.connection_status, worker_config.connection_error))
+        time.sleep(5)
+
+    return worker_config
+
+
+def make_build_queue():
+    """create queue tool box for a build worker (with its own client)
+
+    called once by each build worker process, which reuses it for all of
+    its builds
+    """
+    build_queue = QueueToolBox()
+    build_queue.set_branch_info(load_worker_config())
+    return build_queue
+
+
+def make_doc_client():
+    """create mongo client for a documentation worker process
+    """
+    return load_worker_config().client
+
+
+def start_build_pool():
+    """start pool of build processes on ranks which process requests
+    """
+    global build_pool
+
+    if build_processes < 1:
+        return
+
+    if job.rank == 0 and job.comm.Get_size() > 1:
+        return
+
+    build_pool = BuildPool(build_processes, make_build_queue, branch,
+                           lambda request_id: queue.renew_lease(request_id, owner),
+                           build_done,
+                           renew_interval=lease_renew_interval)
+
+
+def stop_build_pool():
+    """wait for background builds to finish
+    """
+    if build_pool is not None:
+        build_pool.close()
+
+
+def run_request(request_obj):
+    """process request, only logging errors in daemon mode so a single
+    bad request does not stop the daemon
+    """
+    if not daemon:
+        process_request(request_obj)
+        return
+
+    try:
+        process_request(request_obj)
+    except Exception as e:
+        print "error processing request (id: {0})".format(request_obj['_id'])
+        traceback.print_exc()
+
+
+def wait_for_message():
+    """wait for message from rank 0 without busy polling
+    """
+    while not job.comm.Iprobe(source=0, tag=MPI.ANY_TAG):
+        time.sleep(0.1)
+
+
+def run_requests(request_objects):
+    """process requests, distributing them across ranks
+
+    only called on rank 0. returns once all requests are finished. worker
+    ranks receive their requests in worker_loop
+
+    rank 0 seeds each worker rank with a static block of requests, then
+    hands out the remaining requests one at a time to whichever worker
+    finishes first. with a single processor all requests are run on rank 0.
+
+    if a worker fails on a request, no more requests are handed out
+
+    Returns
+        list of errors from worker ranks
+    """
+    size = job.comm.Get_size()
+
+    # workers start a new pass when they get requests from a new run
+    pass_id = time.time()
+
+    if size == 1:
+        queue.start_pass()
+        try:
+            for request_obj in request_objects:
+                run_request(request_obj)
+        finally:
+            build_ready_requests()
+        return []
+
+    pending = list(request_objects)
+    workers = range(1, size)
+
+    # static split of half the queue across workers, remaining
+    # requests are handed out dynamically
+    seed_size = max(1, len(pending) // (2 * len(workers)))
+
+    active = 0
+    for worker in workers:
+        batch = pending[:seed_size]
+        pending = pending[seed_size:]
+        if batch:
+            job.comm.send((pass_id, batch), dest=worker, tag=TAG_WORK)
+            active += 1
+
+    errors = []
+
+    while active > 0:
+        status = MPI.Status()
+        error = job.comm.recv(source=MPI.ANY_SOURCE, tag=TAG_DONE, status=status)
+        worker = status.Get_source()
+
+        if error is not None:
+            errors.append(error)
+            pending = []
+
+        if pending:
+            job.comm.send((pass_id, [pending.pop(0)]), dest=worker, tag=TAG_WORK)
+        else:
+            active -= 1
+
+    return errors
+
+
+def stop_workers():
+    """tell worker ranks to exit worker_loop (only called on rank 0)
+    """
+    for worker in range(1, job.comm.Get_size()):
+        job.comm.send(None, dest=worker, tag=TAG_STOP)
+
+
+def worker_loop():
+    """process requests sent by rank 0 until told to stop
+    """
+    current_pass = None
+
+    while True:
+        wait_for_message()
+
+        status = MPI.Status()
+        message = job.comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+
+        if status.Get_tag() == TAG_STOP:
+            break
+
+        pass_id, batch = message
+
+        if pass_id != current_pass:
+            queue.start_pass()
+            current_pass = pass_id
+
+        # report errors to rank 0 instead of exiting, which would leave
+        # rank 0 waiting on this worker
+        error = None
+        try:
+            try:
+                for request_obj in batch:
+                    run_request(request_obj)
+            finally:
+                build_ready_requests()
+        except Exception as e:
+            traceback.print_exc()
+            error = "rank {0}: {1}".format(job.rank, repr(e))
+
+        job.comm.send(error, dest=0, tag=TAG_DONE)
+
+
+shutdown = []
+
+def handle_shutdown(signum, frame):
+    """stop daemon after current requests are finished
+
+    set on every rank so workers are not killed mid request when signal
+    is forwarded to all ranks. workers exit when rank 0 stops them
+    """
+    print "received signal {0}, shutting down".format(signum)
+    shutdown.append(signum)
+
+
+def run_daemon():
+    """check queue until a shutdown signal is received (rank 0)
+    """
+    interval = POLL_MIN
+
+    last_full_scan = 0
+
+    while not shutdown:
+        print '\n---------------------------------------'
+        print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
+
+        tick_full_scan = time.time() - last_full_scan > FULL_SCAN_INTERVAL
+
+        # errors (e.g. mongo connection problems) are logged and the
+        # daemon backs off before trying again, instead of exiting
+        try:
+            request_objects, exit_message = get_request_objects(tick_full_scan)
+
+            if tick_full_scan:
+                last_full_scan = time.time()
+
+            if len(request_objects) > 0:
+                print "found {0} requests".format(len(request_objects))
+                run_requests(request_objects)
+                interval = POLL_MIN
+            else:
+                interval = min(interval * 2, POLL_MAX)
+
+        except Exception as e:
+            print "error checking queue, retrying"
+            traceback.print_exc()
+            interval = min(interval * 2, POLL_MAX)
+
+        if shutdown:
+            break
+
+        try:
+            queue.wait_for_requests(interval, lambda: len(shutdown) > 0)
+        except Exception as e:
+            print "error waiting for requests"
+            traceback.print_exc()
+            time.sleep(interval)
+
+
+if daemon:
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+
+    start_build_pool()
+
+    try:
+        if job.rank == 0:
+            print "running as daemon"
+            try:
+                run_daemon()
+            finally:
+                # stop worker ranks even if rank 0 failed, so they do
+                # not wait for requests forever
+                stop_workers()
+        else:
+            worker_loop()
+    finally:
+        stop_build_pool()
+
+    if job.rank == 0:
+        print '\n---------------------------------------'
+        print "\nDaemon stopped"
+        print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
+
+    sys.exit(0)
+
+
+request_objects = []
+exit_message = None
+
+start_build_pool()
+
+try:
+    if job.rank == 0:
+        try:
+            # regular cron runs periodically check all waiting requests
+            if len(sys.argv) == 2 and full_scan_due():
+                print "checking all waiting requests"
+                full_scan = True
+
+            request_objects, exit_message = get_request_objects(full_scan)
+
+            if full_scan:
+                mark_full_scan()
+
+            errors = run_requests(request_objects)
+        finally:
+            # stop worker ranks even if rank 0 failed, so they do not
+            # wait for requests forever
+            stop_workers()
+        if errors:
+            raise Exception("error processing requests ({0})".format(
+                "; ".join(errors)))
+    else:
+        worker_loop()
+finally:
+    # let builds already started finish, even if processing stopped
+    # because of an error
+    stop_build_pool()
+
+if exit_message is not None:
+    sys.exit(exit_message)
+
+
+if job.rank == 0:
+    print '\n---------------------------------------'
+    print "\nFinished checking requests"
+    print time.strftime('%Y-%m-%d  %H:%M:%S', time.localtime())
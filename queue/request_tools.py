@@ -7,19 +7,37 @@ import json
 import warnings
 import shutil
 import hashlib
+import getpass
+import tempfile
 import smtplib
+import zipfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from itertools import izip_longest
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 
 import pymongo
+from pymongo import ReturnDocument
 from bson.objectid import ObjectId
 
+import numpy as np
 import pandas as pd
 
 from documentation_tool import DocBuilder
+from doc_assets import shared_assets
+from doc_batch import build_docs
 
 from extract_check import ExtractItem
+from extract_sidecar import ExtractSidecar, iter_sidecar_chunks
+from extract_reader import read_extract_chunks
 from msr_check import MSRItem
+from batch_check import ItemBatch
+from file_index import FileIndex
+from item_cache import StatusCache, CompletionStore
+from base_table import BaseTableCache
+from artifact_tools import ResultArchive, place_file
 
 
 def make_dir(path):
@@ -34,6 +52,55 @@ def make_dir(path):
             raise
 
 
+def merge_field_name(result_field, exfield):
+    """get name of column in merged results for an extract field
+
+    Args
+        result_field (str): name of extract file (without extension)
+        exfield (str): extract field in extract file (exfield_*)
+    """
+
+    # could add something here that attempt to cap field name at 10 chars
+    #
+    # rasters... lookup mini name, extract method abbrv,
+    #            attempt to include temporal infl
+    # msr... use dynamic_merge_count and something else?
+
+    if result_field.endswith('categorical'):
+        tmp_field = "{0}_{1}".format(
+            result_field,
+            exfield[len("exfield_"):])
+
+    elif result_field.endswith('reliability') or result_field.startswith('worldbank_'):
+        tmp_split = result_field.split('.')
+        tmp_field = "{0}.{1}.{2}".format(
+            tmp_split[0],
+            tmp_split[1][0:7], # result_field[:-len('reliability')],
+            exfield[len("exfield_"):])
+
+    else:
+        tmp_field = result_field
+
+    return tmp_field
+
+
+def create_extract_sidecar(args):
+    """create sidecar with columns of extract csv (see ExtractSidecar)
+
+    used to parse extract files in a process pool when merging, so takes
+    a single tuple of arguments
+
+    Args
+        args (tuple): (path of extract csv, path of sidecar, list of
+                      columns to read, chunk size)
+    Returns
+        (bool) whether sidecar was created
+    """
+    extract_path, sidecar_path, usecols, chunk_size = args
+    sidecar = ExtractSidecar(extract_path, path=sidecar_path)
+    return sidecar.create(usecols, chunk_size)
+
+
 def json_sha1_hash(hash_obj):
     hash_json = json.dumps(hash_obj,
                            sort_keys = True,
@@ -56,6 +123,8 @@ class QueueToolBox():
 
         self.c_queue = None
         self.c_email = None
+        self.c_extracts = None
+        self.c_msr = None
 
         self.branch_info = None
         self.branch = None
@@ -64,6 +133,40 @@ class QueueToolBox():
 
         self.msr_resolution = 0.05
 
+        # rows read at a time from each extract when merging
+        # (None reads whole extracts)
+        self.merge_chunk_size = 100000
+
+        # processes used to parse extracts when merging (1 parses extracts
+        # serially in the current process)
+        self.merge_processes = 1
+
+        # use binary sidecars of extracts when merging
+        self.extract_sidecars = True
+
+        # seconds a worker holds a claimed request before it may be
+        # reclaimed by another worker
+        self.lease_time = 60 * 60 * 2
+
+        # change stream used to wait for new requests or changes to
+        # extract/msr items (only available when mongodb is a replica set)
+        self.det_stream = None
+        self.det_stream_enabled = True
+
+        # index of files in extract/msr caches, reused by all requests
+        # in a processing pass
+        self.file_index = FileIndex()
+
+        # status of extract/msr items checked in current processing pass,
+        # shared by all requests in the pass
+        self.status_cache = StatusCache()
+
+        # cache of boundary attribute columns used in merges
+        self.base_table_cache = None
+
+        # zlib compression level of results zip (0 stores files)
+        self.zip_compression_level = 6
+
 
     # def quit(self, rid, status, message):
     #     """exit function used for errors
@@ -86,14 +189,73 @@ class QueueToolBox():
 
         self.c_queue = self.client.asdf.det
         self.c_email = self.client.asdf.email
+        self.c_extracts = self.client.asdf.extracts
+        self.c_msr = self.client.asdf.msr
+
+        # index items by requests waiting on them (see get_woken_requests)
+        for collection in [self.c_extracts, self.c_msr]:
+            try:
+                collection.create_index("det_requests", background=True)
+            except pymongo.errors.PyMongoError as e:
+                print "unable to create det_requests index ({0})".format(e)
 
         self.branch_info = branch_config
         self.branch = branch_config.name
         self.msr_version = branch_config.versions['mean-surface-rasters']
         self.extract_version = branch_config.versions['extract-scripts']
+
+        if 'lease_time' in branch_config.det:
+            self.lease_time = int(branch_config.det['lease_time'])
+
+        if 'merge_chunk_size' in branch_config.det:
+            self.merge_chunk_size = branch_config.det['merge_chunk_size']
+
+        if 'merge_processes' in branch_config.det:
+            self.merge_processes = int(branch_config.det['merge_processes'])
+
+        if 'extract_sidecars' in branch_config.det:
+            self.extract_sidecars = bool(branch_config.det['extract_sidecars'])
+
+        if 'zip_compression_level' in branch_config.det:
+            self.zip_compression_level = int(
+                branch_config.det['zip_compression_level'])
+
+        # local record of completed extract/msr items. sqlite is not
+        # reliable on shared (nfs) filesystems like home directories on
+        # the cluster, so defaults to the node local temp directory
+        completion_store_path = os.path.join(
+            tempfile.gettempdir(), 'det_{0}'.format(getpass.getuser()),
+            self.branch, 'completed.sqlite')
+        if 'completion_store' in branch_config.det:
+            completion_store_path = branch_config.det['completion_store']
+
+        self.status_cache = StatusCache(CompletionStore(completion_store_path))
+
+        # local cache of boundary attribute columns used in merges
+        base_table_path = os.path.join(
+            os.path.expanduser('~'), '.det', self.branch, 'base_tables')
+        if 'base_table_cache' in branch_config.det:
+            base_table_path = branch_config.det['base_table_cache']
+
+        self.base_table_cache = BaseTableCache(base_table_path)
+
         return branch_config
 
 
+    def start_pass(self):
+        """start a new processing pass over the queue
+
+        cached info about extract/msr items from previous passes will
+        be checked again, and documentation templates are reloaded if
+        they changed
+        """
+        self.file_index.new_pass()
+        self.status_cache.clear()
+
+        # pick up changes to documentation templates
+        shared_assets.refresh()
+
+
     def check_id(self, rid):
         """verify request with given id exists
 
@@ -129,6 +291,161 @@ class QueueToolBox():
             return []
 
 
+    def wait_for_requests(self, timeout, stop_check=None):
+        """wait until a new request is submitted, the status of an
+        extract/msr item changes, or timeout is reached
+
+        uses a change stream on the asdf database when available,
+        otherwise just sleeps. the change stream is kept open between
+        calls so changes made while processing are not missed
+
+        Args
+            timeout (int): max seconds to wait
+            stop_check (function): returns True if waiting should stop
+        Returns
+            (bool) whether a change was seen
+        """
+        end_time = time.time() + timeout
+
+        if self.det_stream is None and self.det_stream_enabled:
+            try:
+                self.det_stream = self.client.asdf.watch(
+                    [{"$match": {"$or": [
+                        {
+                            "ns.coll": self.c_queue.name,
+                            "operationType": {"$in": ["insert", "replace"]}
+                        },
+                        {
+                            "ns.coll": {"$in": [self.c_extracts.name, self.c_msr.name]},
+                            "operationType": "update",
+                            "updateDescription.updatedFields.status": {"$exists": True}
+                        }
+                    ]}}],
+                    max_await_time_ms=1000)
+            except pymongo.errors.PyMongoError as e:
+                print "change streams not available, polling queue ({0})".format(e)
+                self.det_stream_enabled = False
+
+        while time.time() < end_time:
+
+            if stop_check is not None and stop_check():
+                return False
+
+            if self.det_stream is not None:
+                try:
+                    if self.det_stream.try_next() is not None:
+                        self.__drain_stream()
+                        return True
+                except pymongo.errors.PyMongoError as e:
+                    # reopen stream on next call
+                    print "change stream error ({0})".format(e)
+                    self.det_stream.close()
+                    self.det_stream = None
+                    time.sleep(1)
+            else:
+                time.sleep(1)
+
+        return False
+
+
+    def __drain_stream(self, max_time=5):
+        """skip changes which are already waiting in change stream
+
+        a burst of changes (e.g. many extracts finishing together) only
+        needs a single pass to handle, so changes received while draining
+        are dropped. stops after max_time seconds if changes keep coming
+        """
+        end_time = time.time() + max_time
+        try:
+            while time.time() < end_time:
+                if self.det_stream.try_next() is None:
+                    break
+        except pymongo.errors.PyMongoError as e:
+            # reopen stream on next call to wait_for_requests
+            print "change stream error ({0})".format(e)
+            self.det_stream.close()
+            self.det_stream = None
+
+
+    def get_woken_requests(self):
+        """get waiting requests (status 0) which may be able to progress
+
+        a request is woken when an extract/msr item it is waiting on is no
+        longer pending (completed or error). check_request registers
+        requests as waiting on items using the det_requests field of
+        items in the extract/msr queues
+
+        requests without progress (added to queue before items were
+        registered) are always included
+
+        ids of requests which are no longer waiting or being processed
+        (completed, error or deleted) are removed from items, so they are
+        not looked up again in later passes
+
+        Returns
+            list of request objects
+        """
+        pending_status = [
+            (self.c_extracts, [0, 2, 3]),
+            (self.c_msr, [0, 2])
+        ]
+
+        # request ids found on each collection
+        collection_ids = []
+
+        for collection, pending in pending_status:
+            # any request id (string) in det_requests, which can use the
+            # det_requests index (see set_branch_info)
+            search = collection.find({
+                "det_requests": {"$gt": ""},
+                "status": {"$nin": pending}
+            }, {"det_requests": 1})
+
+            item_ids = set()
+            for item in search:
+                item_ids.update(item['det_requests'])
+
+            collection_ids.append((collection, item_ids))
+
+        request_ids = set()
+        for collection, item_ids in collection_ids:
+            request_ids.update(item_ids)
+
+        search = self.c_queue.find({
+            "status": 0,
+            "$or": [
+                {"_id": {"$in": [ObjectId(i) for i in request_ids]}},
+                {"progress": {"$exists": False}}
+            ]
+        }).sort([("priority", -1), ("stage.0.time", 1)])
+
+        request_objects = list(search)
+
+        if len(request_ids) > 0:
+            # requests which may still wait on items (new, waiting or
+            # being processed)
+            active = self.c_queue.find({
+                "_id": {"$in": [ObjectId(i) for i in request_ids]},
+                "status": {"$in": [-1, 0, 2]}
+            }, {"_id": 1})
+
+            stale_ids = request_ids - set(str(i['_id']) for i in active)
+
+            for collection, item_ids in collection_ids:
+                collection_stale = list(item_ids & stale_ids)
+                if len(collection_stale) == 0:
+                    continue
+                try:
+                    collection.update(
+                        {"det_requests": {"$in": collection_stale}},
+                        {"$pull": {"det_requests": {"$in": collection_stale}}},
+                        multi=True)
+                except pymongo.errors.PyMongoError as e:
+                    print "unable to remove finished requests from items ({0})".format(e)
+
+        return request_objects
+
+
     def get_status(self, rid):
         """get status of request.
 
@@ -147,8 +464,125 @@ class QueueToolBox():
             raise e
 
 
-    def update_status(self, rid, status, is_prep=False):
+    def get_expired_requests(self):
+        """get claimed requests whose lease has expired
+
+        these were claimed by a worker which did not finish processing
+        them (e.g., worker was killed) and can be reclaimed
+
+        Returns
+            list of request objects
+        """
+        search = self.c_queue.find({
+            "status": 2,
+            "lease.expires": {"$lt": int(time.time())}
+        }).sort([("priority", -1), ("stage.0.time", 1)])
+
+        return list(search)
+
+
+    def claim_request(self, request, owner, lease_time=None):
+        """atomically claim a request for processing
+
+        a request can be claimed if it still has the status it had when
+        it was retrieved from the queue (-1 or 0), or if it was claimed
+        previously (status 2) and the lease has expired. claiming sets
+        status 2 along with the lease owner and expiry. the status the
+        request had before it was first claimed is kept in the lease
+
+        Args
+            request (dict): request object from queue
+            owner (str): unique id of worker claiming request
+            lease_time (int): seconds until lease expires
+        Returns
+            (dict) claimed request object or None if request could not
+            be claimed (request was claimed by another worker)
+        """
+        if lease_time is None:
+            lease_time = self.lease_time
+
+        ctime = int(time.time())
+
+        status = request['status']
+
+        search = {"_id": ObjectId(request['_id'])}
+
+        updates = {
+            "status": 2L,
+            "stage.2.time": ctime,
+            "lease.owner": owner,
+            "lease.expires": ctime + lease_time
+        }
+
+        if status == 2:
+            search['status'] = 2
+            search['lease.expires'] = {"$lt": ctime}
+        else:
+            search['status'] = status
+            updates['lease.status'] = status
+
+        try:
+            claimed = self.c_queue.find_one_and_update(
+                search, {"$set": updates},
+                return_document=ReturnDocument.AFTER)
+        except Exception as e:
+            print ('error claiming request '
+                   '(id: {0}, owner: {1})').format(request['_id'], owner)
+            raise e
+
+        return claimed
+
+
+    def renew_lease(self, rid, owner, lease_time=None):
+        """extend lease on a claimed request
+
+        Args
+            rid (str): request id
+            owner (str): unique id of worker which claimed request
+            lease_time (int): seconds from now until lease expires
+        Returns
+            (bool) whether lease is still held by owner
+        """
+        if lease_time is None:
+            lease_time = self.lease_time
+
+        renewed = self.c_queue.update(
+            {"_id": ObjectId(rid), "status": 2, "lease.owner": owner},
+            {"$set": {"lease.expires": int(time.time()) + lease_time}})
+
+        return renewed['n'] > 0
+
+
+    def mark_received(self, rid, owner):
+        """record that user was emailed that a claimed request was received
+
+        the status a request had before it was first claimed is kept in
+        the lease (see claim_request). it is set to 0 once the email is
+        sent, so a worker which reclaims the request after the lease
+        expires does not prepare the request or send the email again
+
+        Args
+            rid (str): request id
+            owner (str): unique id of worker which claimed request
+        Returns
+            (bool) whether lease is still held by owner
+        """
+        updated = self.c_queue.update(
+            {"_id": ObjectId(rid), "status": 2, "lease.owner": owner},
+            {"$set": {"lease.status": 0L}})
+
+        return updated['n'] > 0
+
+
+    def update_status(self, rid, status, is_prep=False, owner=None):
         """ update status of request
+
+        lease is removed when request leaves the processing status (2).
+        if an owner is given, request is only updated if the owner
+        still holds the lease
+
+        Returns
+            (bool) whether request was updated
         """
         valid_stages = {
             "-2": None,
@@ -172,23 +606,31 @@ class QueueToolBox():
         if is_prep:
             updates['stage.1.time'] = ctime
 
-            column_info_html = ''.join(open(self.dir_base + '/templates/column_info.txt')).replace('\n', '<br/>')
-            updates['info'] = [column_info_html]
+            updates['info'] = [shared_assets.column_info_html()]
 
             # Example push/prepend for info field if needed for manual updates
             # https://docs.mongodb.com/manual/reference/operator/update/push/
             # https://stackoverflow.com/questions/10131957/can-you-have-mongo-push-prepend-instead-of-append
 
+        search = {"_id": ObjectId(rid)}
+        if owner is not None:
+            search['lease.owner'] = owner
+
+        update_doc = {"$set": updates}
+        if status != 2:
+            update_doc["$unset"] = {"lease": ""}
+
         try:
             # update request document
-            self.c_queue.update({"_id": ObjectId(rid)},
-                                {"$set": updates})
+            update = self.c_queue.update(search, update_doc)
 
         except Exception as e:
             print ('error updating status of request '
                    '(id: {0}, status: {1}').format(rid, status)
             raise e
 
+        return update['n'] > 0
+
 
     def send_email(self, receiver, subject, message):
         """send an email
@@ -331,22 +773,141 @@ class QueueToolBox():
 # =============================================================================
 
 
+    def load_progress(self, request, slots):
+        """get progress of items in request
+
+        progress is stored in the request as a list with an entry for each
+        item (release selection or raster file / extract type) in the order
+        they are merged. each entry has the key of the item's extract, the
+        state of the item (pending, queued or done), the extract path
+        and the type/id used for the merge list
+
+        progress is reset (all items pending) if it does not match the
+        items in the request (e.g., extract version changed)
+
+        Args
+            request (dict): request object
+            slots (list): item info built by check_request
+        Returns
+            tuple (list of progress entries, bool whether progress is new)
+        """
+        keys = [list(slot['extract_item'].key) for slot in slots]
+
+        progress = request.get('progress')
+
+        if progress is not None and [list(i['key']) for i in progress] == keys:
+            return progress, False
+
+        progress = [
+            {
+                'key': key,
+                'state': 'pending',
+                'path': None,
+                'type': slot['type'],
+                'id': slot['id']
+            }
+            for key, slot in zip(keys, slots)
+        ]
+
+        return progress, True
+
+
+    def get_merge_list(self, request):
+        """get merge list for request from its progress
+
+        Returns
+            (list) merge list, see check_request
+        """
+        return [(i['path'], i['type'], i['id'])
+                for i in request.get('progress', [])
+                if i['state'] == 'done']
+
+
+    def get_fingerprint(self, request, merge_list):
+        """get fingerprint of request results
+
+        requests with the same fingerprint have the same merged results
+        and aid data. based on the boundary, versions and merge list
+        (which identifies release data by hash, and raster data by file
+        and extract type)
+
+        Returns
+            (str) sha1 hash
+        """
+        fingerprint_data = {
+            'boundary': request['boundary']['name'],
+            'extract_version': self.extract_version,
+            'msr_version': self.msr_version,
+            'release_data': [i.get('hash') for i in request['release_data']],
+            'merge_list': [
+                [os.path.basename(i[0]), i[1], i[2]] if isinstance(i, tuple)
+                else [os.path.basename(i), None, None]
+                for i in merge_list
+            ]
+        }
+
+        return json_sha1_hash(fingerprint_data)
+
+
+    def find_duplicate_results(self, request_id, fingerprint, results_dir):
+        """find results of a completed request with the same fingerprint
+
+        Returns
+            (str) path of merged results of completed request, None if
+            there is no completed request with results available
+        """
+        search = self.c_queue.find({
+            'fingerprint': fingerprint,
+            'status': 1,
+            '_id': {'$ne': ObjectId(request_id)}
+        }).sort([('stage.3.time', -1)])
+
+        for result in search:
+            dup_id = str(result['_id'])
+            dup_output = os.path.join(results_dir, dup_id,
+                                      "{0}_results.csv".format(dup_id))
+
+            if os.path.isfile(dup_output) and os.stat(dup_output).st_size > 0:
+                return dup_output
+
+        return None
+
+
     def check_request(self, request, dry_run=False):
         """check entire request object for cache
+
+        items for all selections in the request are looked up and
+        missing items are added to their queues in bulk (see ItemBatch).
+        the request is registered as waiting on each missing item, and
+        removed from items which are done
+
+        progress of each item is stored in the request, so items which
+        were done in a previous pass are not checked again
         """
         outputs_base = os.path.join(self.branch_info.data_root, "outputs")
         extract_base = os.path.join(outputs_base, self.branch, 'extracts',
                                     self.extract_version.replace('.', '_'))
         msr_base = os.path.join(outputs_base, self.branch, 'msr', 'done')
 
+        batch = ItemBatch(self.status_cache)
+
         merge_list = []
         extract_count = 0
         msr_count = 0
 
+        # updates for msr/extract queues
+        queue_updates = []
+
+        # updates for request (hashes and progress)
+        request_updates = {}
+
+        # one slot for each msr (and its extract) or raster extract needed
+        # for request, in the order they are merged
+        slots = []
+
         # id used for field names in results
         msr_id = 1
 
-        print "\nchecking aid data..."
         for ix, raw_data in enumerate(request['release_data']):
 
             # # mongo was defaulting to 32bit vals for numbers on insert
@@ -384,118 +945,223 @@ class QueueToolBox():
 
             # add hash to request
             if not 'hash' in raw_data or raw_data['hash'] == data_hash:
-                self.c_queue.update(
-                    { "_id": ObjectId(request['_id']) },
-                    { "$set": { 'release_data.'+str(ix)+'.hash' : data_hash}}
-                )
+                request_updates['release_data.'+str(ix)+'.hash'] = data_hash
+
+            msr_item = MSRItem(self.client,
+                               msr_base,
+                               data_hash,
+                               data,
+                               file_index=self.file_index,
+                               status_cache=self.status_cache)
+
+            ###
+            tmp_extract_type = 'reliability'
+            if data["dataset"].startswith('worldbank'):
+                tmp_extract_type = 'sum'
+            ###
+
+            msr_ex_item = ExtractItem(self.client,
+                                      extract_base,
+                                      request["boundary"]["name"],
+                                      data["dataset"],
+                                      data["dataset"] + '_' + data_hash,
+                                      tmp_extract_type,
+                                      data_hash,
+                                      self.extract_version,
+                                      file_index=self.file_index,
+                                      status_cache=self.status_cache)
+
+            slots.append({
+                'type': 'release_data',
+                'id': msr_id,
+                'msr_item': msr_item,
+                'extract_item': msr_ex_item
+            })
+
+            msr_id += 1
 
 
+        for data in request["raster_data"]:
+
+            for i in data["files"]:
+
+                for extract_type in data["options"]["extract_types"]:
+
+                    temporal = i["name"][len(data["name"])+1:]
+
+                    extract_item = ExtractItem(self.client,
+                                               extract_base,
+                                               request["boundary"]["name"],
+                                               data["name"],
+                                               i["name"],
+                                               extract_type,
+                                               temporal,
+                                               self.extract_version,
+                                               file_index=self.file_index,
+                                               status_cache=self.status_cache)
+
+                    slots.append({
+                        'type': 'raster_data',
+                        'id': None,
+                        'msr_item': None,
+                        'extract_item': extract_item
+                    })
+
+
+        progress, new_progress = self.load_progress(request, slots)
+
+        # items which are not done yet
+        outstanding = [slot for slot, entry in zip(slots, progress)
+                       if entry['state'] != 'done']
+
+        print "\n{0} of {1} items done in previous passes".format(
+            len(slots) - len(outstanding), len(slots))
+
+        # items this request no longer waits on
+        done_items = []
+
+
+        print "\nchecking aid data..."
+
+        release_slots = [slot for slot in outstanding
+                         if slot['type'] == 'release_data']
+
+        # check if msr exists in queue and is completed
+        msr_status = batch.resolve([slot['msr_item'] for slot in release_slots])
+
+        # extracts of completed msr
+        msr_ex_slots = []
+
+        for slot, (msr_exists, msr_completed) in zip(release_slots, msr_status):
+
+            data = slot['msr_item'].selection
+            data_hash = slot['msr_item'].data_hash
+
             print ''
             print '\t{0}'.format(data_hash)
             print '\t{0}'.format(data)
             print '\t----------'
 
-            msr_item = MSRItem(self.client,
-                               msr_base,
-                               data_hash,
-                               data)
-
-            # check if msr exists in queue and is completed
-            msr_exists, msr_completed = msr_item.exists()
-
             print '\tmsr exists: {0}'.format(msr_exists)
             print '\tmsr completed: {0}'.format(msr_completed)
 
             if msr_completed == True:
+                msr_ex_slots.append(slot)
+                done_items.append(slot['msr_item'])
+
+            else:
+                msr_count += 1
+                extract_count += 1
+                # add to msr tracker
+                queue_updates.append(
+                    (slot['msr_item'], slot['msr_item'].queue_update()))
 
-                ###
-                tmp_extract_type = 'reliability'
-                if data["dataset"].startswith('worldbank'):
-                    tmp_extract_type = 'sum'
-                ###
 
-                msr_ex_item = ExtractItem(self.client,
-                                          extract_base,
-                                          request["boundary"]["name"],
-                                          data["dataset"],
-                                          data["dataset"] + '_' + data_hash,
-                                          tmp_extract_type,
-                                          data_hash,
-                                          self.extract_version)
+        raster_slots = [slot for slot in outstanding
+                        if slot['type'] == 'raster_data']
 
-                msr_ex_exists, msr_ex_completed = msr_ex_item.exists()
+        # check if extracts exist in queue and are completed
+        extract_status = batch.resolve(
+            [slot['extract_item'] for slot in msr_ex_slots + raster_slots])
 
-                print '\tmsr extract exists: {0}'.format(msr_ex_exists)
-                print '\tmsr extract completed: {0}'.format(msr_ex_completed)
+        msr_ex_status = extract_status[:len(msr_ex_slots)]
+        raster_status = extract_status[len(msr_ex_slots):]
 
-                if not msr_ex_completed:
-                    extract_count += 1
-                    if not dry_run:
-                        # add to extract queue
-                        msr_ex_item.add_to_queue("msr")
 
-                else:
-                    # add to merge list
-                    merge_list.append(
-                        (msr_ex_item.extract_path, 'release_data', msr_id))
+        for slot, (msr_ex_exists, msr_ex_completed) in zip(msr_ex_slots, msr_ex_status):
 
-            else:
-                msr_count += 1
-                extract_count += 1
-                if not dry_run:
-                    # add to msr tracker
-                    msr_item.add_to_queue()
+            msr_ex_item = slot['extract_item']
 
+            print ''
+            print '\t{0}'.format(msr_ex_item.data)
+            print '\tmsr extract exists: {0}'.format(msr_ex_exists)
+            print '\tmsr extract completed: {0}'.format(msr_ex_completed)
 
-            msr_id += 1
+            slot['completed'] = msr_ex_completed
+
+            if not msr_ex_completed:
+                extract_count += 1
+                # add to extract queue
+                queue_updates.append(
+                    (msr_ex_item, msr_ex_item.queue_update("msr")))
+            else:
+                done_items.append(msr_ex_item)
 
 
         print "\nchecking external data..."
-        for data in request["raster_data"]:
-            name = data['name']
+        for slot, (extract_exists, extract_completed) in zip(raster_slots, raster_status):
 
-            for i in data["files"]:
+            extract_item = slot['extract_item']
 
-                for extract_type in data["options"]["extract_types"]:
+            print ''
+            print '\tdataset: {0}'.format(extract_item.dataset)
+            print '\tfile: {0}'.format(extract_item.data)
+            print '\textract type: {0}'.format(extract_item.extract_type)
+            print ''
 
-                    print ''
-                    print '\tdataset: {0}'.format(name)
-                    print '\tfile: {0}'.format(i['name'])
-                    print '\textract type: {0}'.format(extract_type)
-                    print ''
+            print '\textract exists: {0}'.format(extract_exists)
+            print '\textract completed: {0}'.format(extract_completed)
+            print '\t--------------------'
 
-                    temporal = i["name"][len(data["name"])+1:]
+            slot['completed'] = extract_completed
 
-                    extract_item = ExtractItem(self.client,
-                                               extract_base,
-                                               request["boundary"]["name"],
-                                               data["name"],
-                                               i["name"],
-                                               extract_type,
-                                               temporal,
-                                               self.extract_version)
+            # incremenet count if extract is not completed
+            # (whether it exists in queue or not)
+            if not extract_completed:
+                extract_count += 1
+
+                # add to extract queue if it does not already
+                # exist in queue
+                queue_updates.append(
+                    (extract_item, extract_item.queue_update("raster")))
 
-                    # check if extract exists in queue and is completed
-                    extract_exists, extract_completed = extract_item.exists()
+            else:
+                done_items.append(extract_item)
 
-                    print '\textract exists: {0}'.format(extract_exists)
-                    print '\textract completed: {0}'.format(extract_completed)
-                    print '\t--------------------'
 
-                    # incremenet count if extract is not completed
-                    # (whether it exists in queue or not)
-                    if not extract_completed:
-                        extract_count += 1
+        # build merge list and update progress
+        for ix, (slot, entry) in enumerate(zip(slots, progress)):
 
-                        # add to extract queue if it does not already
-                        # exist in queue
-                        if not dry_run:
-                            extract_item.add_to_queue("raster")
+            if entry['state'] == 'done':
+                merge_list.append((entry['path'], entry['type'], entry['id']))
+                continue
 
-                    else:
-                        # add to merge list
-                        merge_list.append(
-                            (extract_item.extract_path, 'raster_data', None))
+            completed = slot.get('completed', False)
+
+            if completed:
+                # add to merge list
+                merge_list.append(
+                    (slot['extract_item'].extract_path, slot['type'], slot['id']))
+
+            if completed == True:
+                state = 'done'
+                path = slot['extract_item'].extract_path
+            else:
+                state = 'queued'
+                path = None
+
+            if state != entry['state']:
+                entry['state'] = state
+                entry['path'] = path
+                if not new_progress and not dry_run:
+                    request_updates['progress.{0}.state'.format(ix)] = state
+                    request_updates['progress.{0}.path'.format(ix)] = path
+
+
+        if not dry_run:
+            if new_progress:
+                request_updates['progress'] = progress
+
+            # add missing items to queues, registering this request as
+            # waiting on them (see get_woken_requests)
+            if len(queue_updates) > 0 or len(done_items) > 0:
+                batch.enqueue(queue_updates, str(request['_id']), done_items)
+
+        if len(request_updates) > 0:
+            self.c_queue.update(
+                { "_id": ObjectId(request['_id']) },
+                { "$set": request_updates }
+            )
 
 
         print ''
@@ -513,17 +1179,38 @@ class QueueToolBox():
 # =============================================================================
 
 
-    def build_output(self, request, merge_list, branch):
+    def results_dir(self):
+        """get path of directory with results of requests
+        """
+        return os.path.join(self.branch_info.data_root, "outputs",
+                            self.branch, "det/results")
+
+
+    def build_output(self, request, merge_list, branch, doc_path=None):
         """build output
 
         merge extracts, generate documentation, update status,
             cleanup working directory, send final email
+
+        if merge_list is None, it is read from the progress
+        stored in the request by check_request
+
+        if a completed request has the same fingerprint (see
+        get_fingerprint), its merged results are reused instead of
+        merging extracts again. request specific files (documentation
+        and request details) are always generated
+
+        if doc_path is given, it is documentation already generated for
+        the request (see build_ready_docs) and is moved into the request
+        dir instead of generating documentation again
         """
+        if merge_list is None:
+            merge_list = self.get_merge_list(request)
+
         request_id = str(request['_id'])
         request['_id'] = request_id
 
-        results_dir = os.path.join(self.branch_info.data_root, "outputs",
-                       self.branch, "det/results")
+        results_dir = self.results_dir()
 
         request_dir = os.path.join(results_dir, request_id)
 
@@ -532,37 +1219,208 @@ class QueueToolBox():
         merge_output = os.path.join(request_dir,
                                     "{0}_results.csv".format(request_id))
 
-        # merge cached results if all are available
-        merge_status = self.merge_file_list(merge_list, merge_output)
+        fingerprint = self.get_fingerprint(request, merge_list)
 
-        if not merge_status:
-            raise Exception('\tWarning: no extracts merged for '
-                            'request_id = {0}').format(request_id)
-        else:
-            print '\tMerge completed for {0}'.format(request_id)
+        dup_output = self.find_duplicate_results(request_id, fingerprint,
+                                                 results_dir)
 
+        make_dir(request_dir)
+
+        # zip of request dir, results are added as they are generated
+        archive = ResultArchive(
+            os.path.join(request_dir, "{0}.zip".format(request_id)),
+            compress_level=self.zip_compression_level)
+
+        try:
+            self.build_archive(request, request_dir, merge_list, merge_output,
+                               dup_output, archive, branch, doc_path)
+        finally:
+            archive.close()
+
+
+        # results can be reused by requests with same fingerprint
+        self.c_queue.update(
+            {"_id": ObjectId(request_id)},
+            {"$set": {"fingerprint": fingerprint}})
+
+
+    def build_archive(self, request, request_dir, merge_list, merge_output,
+                      dup_output, archive, branch, doc_path=None):
+        """generate results for request and add them to archive
+
+        independent stages run concurrently: documentation and aid data
+        are generated in worker threads while extracts are merged into
+        the archive in the current thread. the archive is the join point,
+        other results are added to it once merge is done and all stages
+        have finished
+
+        files which need direct access (merged results, documentation,
+        request details and aid data) are also written to the request dir
+
+        Args
+            request (dict): request object
+            request_dir (str): path of request dir
+            merge_list (list): extracts to merge, see check_request
+            merge_output (str): path for merged results
+            dup_output (str): path of merged results of completed request
+                              with same fingerprint, None if results need
+                              to be merged
+            archive (ResultArchive): zip of request dir
+            branch (str): branch name
+            doc_path (str): documentation already generated for request,
+                            None if it needs to be generated
+        """
+        request_id = request['_id']
 
-        # generate documentation
         doc_output =  os.path.join(request_dir,
                                    "{0}_documentation.pdf".format(request_id))
+
+        msr_aid_dir = os.path.join(request_dir, 'raw_aid_data')
+
+        if doc_path is not None and os.path.isfile(doc_path):
+            # documentation was generated with other ready requests
+            shutil.move(doc_path, doc_output)
+        else:
+            doc_path = None
+
+        doc_stage = None
+
+        pool = ThreadPool(2)
+
+        try:
+            if doc_path is None:
+                doc_stage = pool.apply_async(self.build_doc,
+                                             (request, doc_output))
+            aid_stage = pool.apply_async(self.place_aid_data,
+                                         (request, msr_aid_dir, branch))
+            pool.close()
+
+            self.merge_stage(request, merge_list, merge_output, dup_output,
+                             archive)
+
+            # output request doc as json
+            print "creating request json"
+            rdoc_path = os.path.join(request_dir, "request_details.json")
+            with archive.open("request_details.json",
+                              loose_path=rdoc_path) as rdoc_file:
+                json.dump(request, rdoc_file, indent=4)
+
+            # wait for other stages (raises any error from stage)
+            if doc_stage is not None:
+                doc_stage.get()
+            aid_list = aid_stage.get()
+
+        except:
+            pool.terminate()
+            raise
+
+        finally:
+            pool.join()
+
+
+        archive.write_file(doc_output, os.path.basename(doc_output))
+
+        # geo framework pdf is only needed in zip
+        geo_pdf_src = self.dir_base + "/other/IntroducingtheAidDataGeoFramework.pdf"
+        archive.write_static(geo_pdf_src, "IntroducingtheAidDataGeoFramework.pdf")
+
+        archive.write_dir('raw_aid_data')
+        for aid_path in aid_list:
+            archive.write_file(aid_path,
+                               'raw_aid_data/' + os.path.basename(aid_path))
+
+
+    def merge_stage(self, request, merge_list, merge_output, dup_output,
+                    archive):
+        """merge extracts (or reuse merged results) into archive
+        """
+        request_id = request['_id']
+
+        if dup_output is not None:
+            # reuse merged results of completed request
+            place_file(dup_output, merge_output)
+
+            # copy compressed results from zip of completed request
+            # instead of compressing them again
+            dup_dir = os.path.dirname(dup_output)
+            dup_zip = os.path.join(
+                dup_dir, "{0}.zip".format(os.path.basename(dup_dir)))
+            try:
+                archive.copy_member(dup_zip, os.path.basename(dup_output),
+                                    os.path.basename(merge_output))
+            except (IOError, OSError, KeyError, zipfile.BadZipfile) as e:
+                print '\tUnable to copy results from {0} ({1})'.format(dup_zip, e)
+                archive.write_file(merge_output, os.path.basename(merge_output))
+
+            print '\tReused results from {0}'.format(dup_output)
+
+        else:
+            # merge cached results if all are available
+            merge_status = self.merge_file_list(
+                merge_list, merge_output,
+                chunk_size=self.merge_chunk_size,
+                processes=self.merge_processes,
+                use_sidecars=self.extract_sidecars,
+                base_table_cache=self.base_table_cache,
+                base_table_key=(request['boundary']['name'],
+                                self.extract_version),
+                archive=archive)
+
+            if not merge_status:
+                raise Exception('\tWarning: no extracts merged for '
+                                'request_id = {0}').format(request_id)
+            else:
+                print '\tMerge completed for {0}'.format(request_id)
+
+
+    def build_doc(self, request, doc_output):
+        """generate documentation for request
+        """
         doc = DocBuilder(self.client, request, doc_output, self.branch_info.det['download_server'])
         bd_status = doc.build_doc()
         # print bd_status
+        return bd_status
 
 
-        # output request doc as json
-        print "creating request json"
-        rdoc_path = os.path.join(request_dir, "request_details.json")
-        rdoc_file = open(rdoc_path, "w")
-        json.dump(request, rdoc_file, indent=4)
-        rdoc_file.close()
+    def build_ready_docs(self, requests, make_client, processes=None):
+        """generate documentation for a batch of ready requests in parallel
 
+        see doc_batch.build_docs. documentation is written to a directory
+        next to the request dirs (which are removed when outputs are
+        built) and passed to build_output
 
-        geo_pdf_src = self.dir_base + "/other/IntroducingtheAidDataGeoFramework.pdf"
-        geo_pdf_dst = os.path.join(request_dir, "IntroducingtheAidDataGeoFramework.pdf")
-        shutil.copyfile(geo_pdf_src, geo_pdf_dst)
+        Args
+            requests (list): request objects
+            make_client (function): returns mongo client for worker process
+            processes (int): number of worker processes
+        Returns
+            (dict) request id -> path of documentation, for requests whose
+            documentation was generated
+        """
+        docs_dir = os.path.join(self.results_dir(), '.docs')
+        make_dir(docs_dir)
 
+        jobs = [
+            (request, os.path.join(docs_dir, "{0}_documentation.pdf".format(
+                request['_id'])))
+            for request in requests
+        ]
 
+        results = build_docs(jobs, make_client,
+                             self.branch_info.det['download_server'],
+                             processes=processes)
+
+        return dict((request_id, output)
+                    for request_id, output, seconds, error in results
+                    if error is None)
+
+
+    def place_aid_data(self, request, msr_aid_dir, branch):
+        """place raw aid data for release data of request in aid folder
+
+        Returns
+            (list) paths of aid data files placed
+        """
         # # make msr json folder in request_dir
         # msr_jsons_dir = os.path.join(request_dir, 'msr_jsons')
         # make_dir(msr_jsons_dir)
@@ -581,10 +1439,11 @@ class QueueToolBox():
 
 
         # make msr aid folder in request_dir
-        msr_aid_dir = os.path.join(request_dir, 'raw_aid_data')
         make_dir(msr_aid_dir)
 
-        # copy all aid csv into msr aid folder
+        aid_list = []
+
+        # place all aid csv in msr aid folder (hardlinked when possible)
         for i in request['release_data']:
             tmp_dataset = i['dataset']
             tmp_hash = i['hash']
@@ -594,42 +1453,78 @@ class QueueToolBox():
             dst = os.path.join(msr_aid_dir, "{0}_{1}.csv".format(
                 tmp_dataset, tmp_hash))
             try:
-                shutil.copyfile(src, dst)
+                place_file(src, dst)
             except:
                 pass
+            else:
+                aid_list.append(dst)
 
-
-        # make zip of request dir
-        shutil.make_archive(request_dir, "zip", request_dir)
-
-        # move zip of request dir into request dir
-        shutil.move(request_dir + ".zip", request_dir)
-
-
-        # remove unzipped files which do not need direct access
-        os.remove(geo_pdf_dst)
-        # shutil.rmtree(msr_jsons_dir)
-
-
-
+        return aid_list
 
 
-    def merge_file_list(self, file_list, merge_output):
+    def merge_file_list(self, file_list, merge_output, chunk_size=None,
+                        processes=None, use_sidecars=False,
+                        base_table_cache=None, base_table_key=None,
+                        archive=None):
         """merge extracts for given file list
 
         outputs to given csv path
 
+        extract files are read in aligned chunks of rows (all extracts
+        for a boundary have the same rows in the same order) and each
+        merged chunk is written to the output as it is built, so memory
+        use is bounded by the chunk size instead of the size of the
+        boundary. only the asdf_id and extract fields are read from files
+        after the first. columns have the type they have in the whole
+        file in every chunk (see read_extract_chunks), so values are
+        written the same way in every chunk
+
+        if sidecars are used, extract columns are memory mapped from the
+        sidecar of each file instead of parsing the csv. files without a
+        valid sidecar are parsed one chunk at a time into a new sidecar,
+        which is then memory mapped
+
+        if multiple processes are used, files after the first are parsed
+        into sidecars in parallel by a process pool (temporary sidecars
+        next to the merged output, removed after the merge, if sidecars
+        are not used). results are merged in the same order as the file
+        list
+
+        if a base table cache is given, the non extract columns (asdf_id
+        and boundary attributes) are read from the cached table for the
+        boundary instead of the first file, and only extract columns are
+        read from the first file. the table is created from the first
+        file (one chunk at a time) if it is not cached, and the first file
+        is read in chunks if the cache is not writable
+
         Args:
         file_list (list): contains file paths of extract csv files
                           to merge. may be a tuple, to pass additional
                           info, but extract file path must be first item
 
         merge_output (str): absolute path for merged output file
-        """
 
-        field_list = ['asdf_id']
+        chunk_size (int): number of rows to read from each file at a
+                          time. all rows are read at once if None
 
-        merged_df = 0
+        processes (int): number of processes used to parse extract files.
+                         files are parsed serially if None or 1
+
+        use_sidecars (bool): read columns of files after the first from
+                             binary sidecars (see ExtractSidecar) when
+                             available, and create sidecars for files
+                             which do not have one
+
+        base_table_cache (BaseTableCache): cache of non extract columns
+                                           of extracts
+
+        base_table_key (tuple): (boundary name, extract version) used to
+                                lookup non extract columns in cache
+
+        archive (ResultArchive): archive merged output is also written to
+                                 (as it is written to merge_output)
+        """
+        result_csv_list = []
         for file_info in file_list:
 
             if isinstance(file_info, tuple):
@@ -641,70 +1536,251 @@ class QueueToolBox():
             if not os.path.isfile(result_csv):
                 raise Exception("missing file ({0})".format(result_csv))
 
+            result_csv_list.append(result_csv)
+
+
+        if len(result_csv_list) == 0:
+            print '\tWarning: no extracts merged'
+            return False
 
-            result_df = pd.read_csv(result_csv, quotechar='\"',
-                                    na_values='', keep_default_na=False)
 
+        # (columns to read, {extract field: merged field name}) for each file
+        file_fields = []
+
+        for ix, result_csv in enumerate(result_csv_list):
+
+            columns = list(pd.read_csv(result_csv, quotechar='\"',
+                                       nrows=0).columns)
 
             exfields = [
-                cname for cname in list(result_df.columns)
+                cname for cname in columns
                 if cname.startswith("exfield_")
             ]
 
-            if not isinstance(merged_df, pd.DataFrame):
-                merged_df = result_df.copy(deep=True)
-                merged_df.drop(exfields, axis=1, inplace=True)
+            if ix == 0:
+                # non extract columns of first file are kept
+                base_fields = [cname for cname in columns
+                               if cname not in exfields]
 
+            usecols = ['asdf_id'] + exfields
 
             result_field = result_csv[result_csv.rindex('/')+1:-4]
 
-            # could add something here that attempt to cap field name at 10 chars
-            #
-            # rasters... lookup mini name, extract method abbrv,
-            #            attempt to include temporal infl
-            # msr... use dynamic_merge_count and something else?
+            rename = OrderedDict()
+            for c in exfields:
+                tmp_field = merge_field_name(result_field, c)
+                rename[c] = tmp_field
 
+            file_fields.append((usecols, rename))
 
-            for c in exfields:
 
-                if result_field.endswith('categorical'):
-                    tmp_field = "{0}_{1}".format(
-                        result_field,
-                        c[len("exfield_"):])
+        readers = [None] * len(result_csv_list)
 
-                elif result_field.endswith('reliability') or result_field.startswith('worldbank_'):
-                    tmp_split = result_field.split('.')
-                    tmp_field = "{0}.{1}.{2}".format(
-                        tmp_split[0],
-                        tmp_split[1][0:7], # result_field[:-len('reliability')],
-                        c[len("exfield_"):])
+        # reader for non extract columns (None if they are read from the
+        # first file along with its extract columns)
+        base_reader = None
 
-                else:
-                    tmp_field = result_field
+        if base_table_cache is not None and base_table_key is not None:
+            base_reader = base_table_cache.load(base_table_key, base_fields,
+                                                chunk_size)
+
+            if base_reader is None:
+                base_table_cache.create(base_table_key, result_csv_list[0],
+                                        base_fields, chunk_size)
+                base_reader = base_table_cache.load(base_table_key,
+                                                    base_fields, chunk_size)
+
+            if base_reader is None:
+                # cache is not writable, read columns from first file
+                # (read_csv keeps order of file, not of usecols)
+                base_reader = (
+                    chunk[base_fields] for chunk in read_extract_chunks(
+                        result_csv_list[0], usecols=base_fields,
+                        chunk_size=chunk_size))
+
+        else:
+            # first file is read from csv with all columns
+            # (only numeric columns are stored in sidecars)
+            readers[0] = read_extract_chunks(result_csv_list[0],
+                                             chunk_size=chunk_size)
+
+        # files which need to be parsed into sidecars
+        parse_list = []
+
+        for ix in range(len(result_csv_list)):
+
+            if readers[ix] is not None:
+                continue
+
+            usecols = file_fields[ix][0]
+
+            if use_sidecars:
+                arrays = ExtractSidecar(result_csv_list[ix]).load(usecols)
+                if arrays is not None:
+                    readers[ix] = iter_sidecar_chunks(arrays, chunk_size)
+                    continue
+
+            if use_sidecars or (processes is not None and processes > 1):
+                parse_list.append(ix)
 
+            else:
+                readers[ix] = read_extract_chunks(result_csv_list[ix],
+                                                  usecols=usecols,
+                                                  chunk_size=chunk_size)
+
+
+        # generate output folder for merged df using request id
+        make_dir(os.path.dirname(merge_output))
+
+        # directory of temporary sidecars (used when sidecars are not kept
+        # next to extracts), removed after merge
+        tmp_dir = None
+
+        try:
+            if len(parse_list) > 0:
+
+                if not use_sidecars:
+                    tmp_dir = tempfile.mkdtemp(
+                        prefix='.tmp_merge_', dir=os.path.dirname(merge_output))
+
+                sidecars = []
+                for ix in parse_list:
+                    sidecar_path = None
+                    if tmp_dir is not None:
+                        sidecar_path = os.path.join(tmp_dir, str(ix))
+                    sidecars.append(ExtractSidecar(result_csv_list[ix],
+                                                   path=sidecar_path))
+
+                parse_args = [
+                    (sidecar.extract_path, sidecar.path, file_fields[ix][0],
+                     chunk_size)
+                    for ix, sidecar in zip(parse_list, sidecars)
+                ]
+
+                if processes is not None and processes > 1 and len(parse_args) > 1:
+                    # parse files in parallel
+                    pool = multiprocessing.Pool(min(processes, len(parse_args)))
+                    try:
+                        pool.map(create_extract_sidecar, parse_args)
+                        pool.close()
+                    except:
+                        pool.terminate()
+                        raise
+                    finally:
+                        pool.join()
 
-                merged_df[tmp_field] = result_df[c]
-                field_list.append(tmp_field)
+                else:
+                    map(create_extract_sidecar, parse_args)
 
+                for ix, sidecar in zip(parse_list, sidecars):
+                    usecols = file_fields[ix][0]
+                    arrays = sidecar.load(usecols)
+                    if arrays is not None:
+                        readers[ix] = iter_sidecar_chunks(arrays, chunk_size)
+                    else:
+                        # sidecar could not be created (e.g. extract cache
+                        # is not writable or columns are not numeric)
+                        readers[ix] = read_extract_chunks(result_csv_list[ix],
+                                                          usecols=usecols,
+                                                          chunk_size=chunk_size)
 
-        if isinstance(merged_df, pd.DataFrame):
+            self.write_merged_chunks(readers, base_reader, file_fields,
+                                     base_fields, merge_output, archive)
 
-            # reorder columns to put id and extract columns first
-            field_list += [i for i in list(merged_df.columns)
-                           if i not in field_list]
-            merged_df = merged_df[field_list]
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
 
-            # output merged dataframe to csv
-            # generate output folder for merged df using request id
-            make_dir(os.path.dirname(merge_output))
+        print '\tResults output to {0}'.format(merge_output)
+        return True
 
-            # write merged df to csv
-            merged_df.to_csv(merge_output, index=False)
-            print '\tResults output to {0}'.format(merge_output)
-            return True
 
+    def write_merged_chunks(self, readers, base_reader, file_fields,
+                            base_fields, merge_output, archive=None):
+        """merge chunks of rows from extract readers and write them to the
+        merged output (see merge_file_list)
+        """
+        # output merged dataframe to csv
+        if archive is not None:
+            merge_file = archive.open(os.path.basename(merge_output),
+                                      loose_path=merge_output)
         else:
-            print '\tWarning: no extracts merged'
-            return False
+            merge_file = open(merge_output, 'w')
+
+        with merge_file:
+
+            if base_reader is not None:
+                readers = [base_reader] + readers
+
+            for chunk_ix, chunks in enumerate(izip_longest(*readers)):
+
+                if any(chunk is None for chunk in chunks):
+                    raise Exception("extract files to merge have different "
+                                    "number of rows ({0})".format(merge_output))
+
+                if base_reader is not None:
+                    base_chunk, chunks = chunks[0], chunks[1:]
+                else:
+                    base_chunk = chunks[0]
+
+                merged_df = self.merge_chunks(base_chunk, chunks, file_fields,
+                                              base_fields)
+
+                # write merged chunk to csv (as a string since archive
+                # members are not regular files)
+                merge_file.write(merged_df.to_csv(index=True,
+                                                  header=(chunk_ix == 0)))
+
+
+    def merge_chunks(self, base_chunk, chunks, file_fields, base_fields):
+        """merge the same rows of each extract file
+
+        extract columns from all files are renamed and joined in a single
+        concat on the asdf_id index. rows of each file are matched to the
+        rows of the base table by asdf_id (not just position) and an error
+        is raised if the files do not have the same asdf_id values
+
+        Args
+            base_chunk (dataframe): rows of non extract columns
+            chunks (list): dataframe for each extract file
+            file_fields (list): (columns read, {extract field: merged field})
+                                for each extract file
+            base_fields (list): non extract columns
+        Returns
+            (dataframe) merged rows indexed by asdf_id, with extract columns
+            first followed by other non extract columns
+        """
+        index = pd.Index(base_chunk['asdf_id'].values, name='asdf_id')
+
+        parts = []
+        for result_df, (usecols, rename) in zip(chunks, file_fields):
+
+            result_ids = result_df['asdf_id'].values
+
+            part = result_df[list(rename.keys())]
+            part.columns = list(rename.values())
+
+            if np.array_equal(result_ids, index.values):
+                part.index = index
+
+            else:
+                # rows are in a different order, match using asdf_id
+                if (len(result_ids) != len(index)
+                        or not index.is_unique
+                        or set(result_ids) != set(index.values)):
+                    raise Exception("extract files to merge do not have "
+                                    "the same rows (asdf_id)")
+
+                part.index = pd.Index(result_ids, name='asdf_id')
+                part = part.reindex(index)
+
+            parts.append(part)
+
+        other_fields = [i for i in base_fields if i != 'asdf_id']
+        base_part = base_chunk[other_fields]
+        base_part.index = index
+        parts.append(base_part)
 
+        merged_df = pd.concat(parts, axis=1, copy=False)
 
+        return merged_df
@@ -0,0 +1,134 @@
+"""round trip tests for ResultArchive
+
+ArchiveMember writes members using zipfile internals, so these check
+that archives written with it can still be read (and pass testzip) with
+the zipfile module of the current interpreter
+"""
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from artifact_tools import ResultArchive
+
+
+class ResultArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.tmp_dir, 'results.zip')
+
+        self.csv_data = ''.join('{0},{1},{2}\n'.format(i, i * 0.5, 'x' * (i % 7))
+                                for i in range(20000))
+
+        self.src_path = os.path.join(self.tmp_dir, 'src.csv')
+        with open(self.src_path, 'wb') as src:
+            src.write(self.csv_data)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def build_archive(self, compress_level):
+        loose_path = os.path.join(self.tmp_dir, 'loose.csv')
+
+        archive = ResultArchive(self.zip_path, compress_level)
+        try:
+            with archive.open('streamed.csv', loose_path=loose_path) as member:
+                for ix in range(0, len(self.csv_data), 4096):
+                    member.write(self.csv_data[ix:ix+4096])
+
+            archive.write_file(self.src_path, 'copied.csv')
+            archive.write_static(self.src_path, 'static.csv')
+            archive.write_dir('raw_aid_data')
+            archive.write_file(self.src_path, 'raw_aid_data/copied.csv')
+        finally:
+            archive.close()
+
+        with open(loose_path, 'rb') as loose:
+            self.assertEqual(loose.read(), self.csv_data)
+
+
+    def check_archive(self, compress_type):
+        zf = zipfile.ZipFile(self.zip_path)
+        try:
+            self.assertIsNone(zf.testzip())
+
+            self.assertEqual(
+                zf.namelist(),
+                ['streamed.csv', 'copied.csv', 'static.csv', 'raw_aid_data/',
+                 'raw_aid_data/copied.csv'])
+
+            for name in ['streamed.csv', 'copied.csv', 'static.csv',
+                         'raw_aid_data/copied.csv']:
+                self.assertEqual(zf.read(name), self.csv_data)
+                self.assertEqual(zf.getinfo(name).compress_type, compress_type)
+        finally:
+            zf.close()
+
+
+    def test_deflated(self):
+        self.build_archive(6)
+        self.check_archive(zipfile.ZIP_DEFLATED)
+
+
+    def test_stored(self):
+        self.build_archive(0)
+        self.check_archive(zipfile.ZIP_STORED)
+
+
+    def test_copy_member(self):
+        for compress_level, compress_type in [
+                (6, zipfile.ZIP_DEFLATED), (0, zipfile.ZIP_STORED)]:
+            self.build_archive(compress_level)
+
+            copy_path = os.path.join(self.tmp_dir, 'copy.zip')
+
+            # compressed data is copied as is, whatever the compression
+            # level of the archive it is copied to
+            archive = ResultArchive(copy_path, 6 - compress_level)
+            try:
+                archive.write_file(self.src_path, 'copied.csv')
+                archive.copy_member(self.zip_path, 'streamed.csv', 'reused.csv')
+                archive.copy_member(self.zip_path, 'static.csv', 'static.csv')
+                self.assertRaises(KeyError, archive.copy_member,
+                                  self.zip_path, 'missing.csv', 'missing.csv')
+            finally:
+                archive.close()
+
+            zf = zipfile.ZipFile(copy_path)
+            try:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.namelist(),
+                                 ['copied.csv', 'reused.csv', 'static.csv'])
+                for name in zf.namelist():
+                    self.assertEqual(zf.read(name), self.csv_data)
+                self.assertEqual(zf.getinfo('reused.csv').compress_type,
+                                 compress_type)
+            finally:
+                zf.close()
+
+
+    def test_zip64_sizes(self):
+        # members larger than the zip64 limit need zip64 extra fields in
+        # their local and central directory headers. lower the limit so
+        # the test does not need to write 4GB members
+        zip64_limit = zipfile.ZIP64_LIMIT
+        zipfile.ZIP64_LIMIT = 1024
+        try:
+            for compress_level, compress_type in [
+                    (6, zipfile.ZIP_DEFLATED), (0, zipfile.ZIP_STORED)]:
+                self.build_archive(compress_level)
+                self.check_archive(compress_type)
+        finally:
+            zipfile.ZIP64_LIMIT = zip64_limit
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+"""tests that merged extracts match the output of the original merge
+
+the original merge read every extract csv whole and wrote the merged
+table with a single to_csv. merge_file_list reads extracts in chunks of
+rows, from sidecars or from a cached base table, and must write exactly
+the same bytes
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from request_tools import QueueToolBox
+from base_table import BaseTableCache
+
+
+def reference_merge(file_list, merge_output):
+    """merge extracts the way the original merge_file_list did
+    """
+    field_list = ['asdf_id']
+
+    merged_df = None
+    for result_csv in file_list:
+
+        result_df = pd.read_csv(result_csv, quotechar='\"',
+                                na_values='', keep_default_na=False)
+
+        exfields = [cname for cname in list(result_df.columns)
+                    if cname.startswith("exfield_")]
+
+        if merged_df is None:
+            merged_df = result_df.copy(deep=True)
+            merged_df.drop(exfields, axis=1, inplace=True)
+
+        result_field = result_csv[result_csv.rindex('/')+1:-4]
+
+        for c in exfields:
+            if result_field.endswith('categorical'):
+                tmp_field = "{0}_{1}".format(result_field, c[len("exfield_"):])
+            elif result_field.endswith('reliability') or result_field.startswith('worldbank_'):
+                tmp_split = result_field.split('.')
+                tmp_field = "{0}.{1}.{2}".format(
+                    tmp_split[0], tmp_split[1][0:7], c[len("exfield_"):])
+            else:
+                tmp_field = result_field
+
+            merged_df[tmp_field] = result_df[c]
+            field_list.append(tmp_field)
+
+    field_list += [i for i in list(merged_df.columns) if i not in field_list]
+    merged_df = merged_df[field_list]
+    merged_df.to_csv(merge_output, index=False)
+
+
+class MergeTest(unittest.TestCase):
+
+    rows = 2500
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(self.cache_dir)
+
+        self.files = [
+            self.write_extract('udel.2000.mean', self.int_value),
+            self.write_extract('udel.2001.mean', self.float_value),
+            self.write_extract('udel.2002.max', self.late_blank_value),
+            self.write_extract('aims_x.abcdef1234.reliability', self.float_value,
+                               exfields=['sum', 'potential', 'reliability']),
+            self.write_extract('lc.2005.categorical', self.int_value,
+                               exfields=['10', '20'])
+        ]
+
+        self.reference = os.path.join(self.tmp_dir, 'reference.csv')
+        reference_merge(self.files, self.reference)
+
+        with open(self.reference) as reference:
+            self.reference_data = reference.read()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+    def int_value(self, i, j):
+        return str(i * 3 + j)
+
+
+    def float_value(self, i, j):
+        return str(i * 0.25 + j)
+
+
+    def late_blank_value(self, i, j):
+        # int values with blanks only after the first chunks, so chunks
+        # infer different types than the whole file
+        if i > 2000 and i % 17 == 0:
+            return ''
+        return str(i + j)
+
+
+    def write_extract(self, name, value, exfields=None):
+        if exfields is None:
+            exfields = [None]
+
+        columns = ['exfield_{0}'.format(f) if f is not None else 'exfield_x'
+                   for f in exfields]
+
+        path = os.path.join(self.cache_dir, name + '.csv')
+
+        with open(path, 'w') as extract:
+            extract.write(','.join(['asdf_id', 'name', 'pop'] + columns) + '\n')
+            for i in range(self.rows):
+                # boundary attribute with a late blank
+                pop = '' if i == self.rows - 3 else str(i * 10)
+                values = [value(i, j) for j in range(len(columns))]
+                extract.write(','.join(
+                    [str(i + 1), '"unit {0}"'.format(i), pop] + values) + '\n')
+
+        return path
+
+
+    def check_merge(self, **kwargs):
+        merge_output = os.path.join(self.tmp_dir, 'merged.csv')
+
+        merge_status = QueueToolBox().merge_file_list(
+            self.files, merge_output, **kwargs)
+
+        self.assertTrue(merge_status)
+
+        with open(merge_output) as merged:
+            self.assertEqual(merged.read(), self.reference_data,
+                             'merged output differs ({0})'.format(kwargs))
+
+        os.remove(merge_output)
+
+
+    def test_unchunked(self):
+        self.check_merge(chunk_size=None)
+
+
+    def test_chunked(self):
+        for chunk_size in [1000, 777, self.rows, self.rows + 1]:
+            self.check_merge(chunk_size=chunk_size)
+
+
+    def test_processes(self):
+        self.check_merge(chunk_size=1000, processes=2)
+
+
+    def test_sidecars(self):
+        # sidecars are created by first merge and used by second
+        for ix in range(2):
+            self.check_merge(chunk_size=1000, use_sidecars=True)
+            self.check_merge(chunk_size=1000, processes=2, use_sidecars=True)
+
+
+    def test_base_table_cache(self):
+        base_table_cache = BaseTableCache(os.path.join(self.tmp_dir, 'base'))
+        for ix in range(2):
+            self.check_merge(chunk_size=1000, use_sidecars=True,
+                             base_table_cache=base_table_cache,
+                             base_table_key=('bnd', '1.0'))
+            self.check_merge(chunk_size=777,
+                             base_table_cache=base_table_cache,
+                             base_table_key=('bnd', '1.0'))
+            self.check_merge(chunk_size=None,
+                             base_table_cache=base_table_cache,
+                             base_table_key=('bnd', '1.0'))
+
+
+    def test_base_table_cache_not_replaced(self):
+        # table being read by a merge is kept when another merge creates it
+        base_table_cache = BaseTableCache(os.path.join(self.tmp_dir, 'base'))
+        key = ('bnd', '1.0')
+        fields = ['asdf_id', 'name', 'pop']
+
+        self.assertTrue(base_table_cache.create(key, self.files[0], fields, 1000))
+        reader = base_table_cache.load(key, fields, 1000)
+        first = next(reader)
+
+        self.assertTrue(base_table_cache.create(key, self.files[1], fields,
+                                                self.rows))
+
+        rows = len(first) + sum(len(chunk) for chunk in reader)
+        self.assertEqual(rows, self.rows)
+
+
+    def test_base_table_cache_not_writable(self):
+        # cache path under a regular file can not be created
+        base_table_cache = BaseTableCache(os.path.join(self.files[0], 'base'))
+        self.check_merge(chunk_size=777,
+                         base_table_cache=base_table_cache,
+                         base_table_key=('bnd', '1.0'))
+
+
+if __name__ == '__main__':
+    unittest.main()